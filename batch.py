@@ -0,0 +1,243 @@
+import os, io, sys, json, time, hashlib, argparse, datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import retraceit as rt
+import img_encode
+
+# reports that can be generated for each history: name -> output file name
+# (images take the extension of the chosen format)
+REPORTS = {
+    'stop':  'stop_stats.png',
+    'hr':    'time_stats.png',
+    'month': 'month_stats.png',
+    'spend': 'monthly_cost_stats.png',
+    'route': 'route_stats.png',
+    'text':  'stop_stats.txt',
+    'json':  'stats.json',
+}
+DEFAULT_REPORTS = 'stop,hr,month,spend,json'
+
+PROGRESS_FNAME = 'batch_progress.jsonl'
+SUMMARY_FNAME  = 'batch_summary.json'
+
+# the db used by workers. With the fork start method it is loaded once by the
+# parent before the pool starts, and shared with the workers copy-on-write.
+# Otherwise, each worker loads its own; the GTFS feeds are still shared, as
+# they are read in place from their mapped snapshots.
+_db = None
+
+def find_histories(source) -> list:
+    '''
+    Return (key, path) for each Compass csv export in source, which is either
+    a directory (searched recursively for .csv files) or a manifest file
+    listing one path per line (relative paths are relative to the manifest)
+        - key identifies the history in the output directory and progress
+          file: its path relative to source, without the .csv extension
+    '''
+    if os.path.isdir(source):
+        root = source
+        paths = []
+        for dir_path, dir_names, fnames in os.walk(source):
+            dir_names.sort()
+            paths += [os.path.join(dir_path, fname) for fname in sorted(fnames)
+                      if fname.lower().endswith('.csv')]
+    else:
+        root = os.path.dirname(os.path.abspath(source))
+        with open(source, encoding='utf-8') as fp:
+            paths = [os.path.join(root, line.strip()) for line in fp
+                     if line.strip() and not line.startswith('#')]
+
+    histories = []
+    for path in paths:
+        key = os.path.splitext(os.path.relpath(path, root))[0]
+        if key.startswith('..'):
+            # outside of the manifest's directory
+            key = '%s-%s' % (os.path.splitext(os.path.basename(path))[0],
+                             hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:8])
+        histories.append((key.replace(os.sep, '/'), path))
+    return histories
+
+def stats_json(stats: rt.HistoryStats, stops: dict, num) -> dict:
+    '''
+    Return the statistics of a history as a json-serializable dict
+    '''
+    return {'total_taps': stats.total_taps, 'total_spend': round(stats.total_spend, 2),
+            'top_stops': [{'stop': stop, 'name': stops.get(stop, stop), 'count': count}
+                          for stop, count in rt.get_top_counts(stats.stop_counts, num)],
+            'hr_counts': stats.hr_counts, 'month_counts': stats.month_counts,
+            'month_spend': {month: round(spend, 2) for month, spend in stats.month_spend.items()}}
+
+def process_history(key, path, out_dir, reports, width, num, since=None, until=None,
+                    fmt=img_encode.IMG_FORMAT, compress_level=None) -> dict:
+    '''
+    Generate the given reports for the history at path into out_dir/key/,
+    returning its progress record
+        - only taps from since to until (dates, see analyze_history) are
+          counted if either is given
+        - images are encoded as fmt with compress_level (see img_encode.encode)
+    '''
+    start = time.perf_counter()
+    record = {'key': key, 'path': path}
+    try:
+        with open(path, encoding='utf-8') as fp:
+            stats = rt.analyze_history(fp.read(), since, until)
+
+        hist_dir = os.path.join(out_dir, key)
+        os.makedirs(hist_dir, exist_ok=True)
+        out_bytes = 0
+        for report in reports:
+            out_path = os.path.join(hist_dir, REPORTS[report])
+            if report in ('text', 'json'):
+                with open(out_path, 'w', encoding='utf-8') as fp:
+                    fp.write(_text_report(report, stats, num))
+            else:
+                if report == 'stop':
+                    img = rt.stop_stats_img(stats, _db, width=width, num=num)
+                elif report == 'route':
+                    img = rt.route_stats_img(stats, _db, width=width, num=num)
+                elif report == 'hr':
+                    img = rt.hr_stats_img(stats, _db, width=width)
+                else:
+                    img = rt.month_stats_img(stats, _db, width=width, spend=(report == 'spend'))
+                out_path = os.path.join(hist_dir, img_encode.filename(os.path.splitext(REPORTS[report])[0], fmt))
+                with open(out_path, 'wb') as fp:
+                    fp.write(img_encode.encode(img, fmt, compress_level))
+            out_bytes += os.path.getsize(out_path)
+
+        record.update({'status': 'ok', 'taps': stats.total_taps, 'bytes': out_bytes})
+    except Exception as e:
+        record.update({'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    return record
+
+def _text_report(report, stats, num) -> str:
+    if rt.system_t.TRANSLINK not in _db.feeds:
+        return _format_text_report(report, stats, {}, num)
+    with _db.use_gtfs(rt.system_t.TRANSLINK) as system_gtfs:
+        return _format_text_report(report, stats, system_gtfs.stop_id_to_code, num)
+
+def _format_text_report(report, stats, stops, num) -> str:
+    if report == 'json':
+        return json.dumps(stats_json(stats, stops, num), indent=1)
+    text = io.StringIO()
+    rt.print_top_counts(rt.get_top_counts(stats.stop_counts, num), stops, file=text)
+    return text.getvalue()
+
+def _init_worker():
+    global _db
+    if _db is None:
+        _db = rt.retraceit_db()
+        _db.warm_up(background=False)
+
+def read_progress(out_dir) -> dict:
+    '''
+    Return the latest progress record of each history processed by an
+    earlier run into out_dir
+    '''
+    progress = {}
+    path = os.path.join(out_dir, PROGRESS_FNAME)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # cut off by an interrupted run
+                    continue
+                progress[record['key']] = record
+    return progress
+
+def run_batch(source, out_dir, reports, workers=None, width=1050, num=14, resume=False,
+              since=None, until=None, fmt=img_encode.IMG_FORMAT, compress_level=None) -> dict:
+    '''
+    Generate reports for every history in source (see find_histories) into
+    out_dir, using a pool of worker processes, and return a summary of the run
+        - each finished history is recorded in out_dir/batch_progress.jsonl;
+          if resume is set, histories that were already processed
+          successfully are skipped
+        - since/until limit the taps counted, and fmt/compress_level set how
+          images are encoded (see process_history)
+    '''
+    histories = find_histories(source)
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+
+    done = read_progress(out_dir) if resume else {}
+    todo = [(key, path) for key, path in histories if done.get(key, {}).get('status') != 'ok']
+    print("%d histories found, %d to process" % (len(histories), len(todo)))
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+        # load everything before forking, so that the workers share it
+        _init_worker()
+    else:
+        mp_context = multiprocessing.get_context()
+
+    start = time.perf_counter()
+    counts = {'ok': 0, 'error': 0}
+    taps = out_bytes = 0
+    with open(os.path.join(out_dir, PROGRESS_FNAME), 'a' if resume else 'w', encoding='utf-8') as progress_fp, \
+         ProcessPoolExecutor(workers, mp_context=mp_context, initializer=_init_worker) as pool:
+        jobs = [pool.submit(process_history, key, path, out_dir, reports, width, num, since, until,
+                            fmt, compress_level)
+                for key, path in todo]
+        for job_idx, job in enumerate(as_completed(jobs)):
+            record = job.result()
+            progress_fp.write(json.dumps(record) + '\n')
+            progress_fp.flush()
+
+            counts[record['status']] += 1
+            taps += record.get('taps', 0)
+            out_bytes += record.get('bytes', 0)
+            if record['status'] != 'ok':
+                print("%s: %s" % (record['path'], record['error']))
+            if (job_idx + 1) % 100 == 0:
+                print("%d/%d histories processed" % (job_idx + 1, len(todo)))
+
+    elapsed = time.perf_counter() - start
+    summary = {'histories': len(histories), 'skipped': len(histories) - len(todo),
+               'ok': counts['ok'], 'failed': counts['error'], 'taps': taps,
+               'output_mb': round(out_bytes / (1 << 20), 2), 'seconds': round(elapsed, 2),
+               'histories_per_s': round(len(todo) / elapsed, 2) if elapsed else None,
+               'taps_per_s': round(taps / elapsed) if elapsed else None,
+               'workers': workers, 'reports': reports, 'format': fmt}
+    with open(os.path.join(out_dir, SUMMARY_FNAME), 'w', encoding='utf-8') as fp:
+        json.dump(summary, fp, indent=2)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate Retraceit reports for many Compass card histories at once.')
+    parser.add_argument('source', help='directory of csv exports, or a file listing one csv path per line')
+    parser.add_argument('out_dir', help='directory to write reports to')
+    parser.add_argument('--reports', default=DEFAULT_REPORTS,
+                        help='comma separated reports to generate, out of %s (default: %s)' % (', '.join(REPORTS), DEFAULT_REPORTS))
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: one per cpu)')
+    parser.add_argument('--width', type=int, default=1050, help='width of the generated images, in pixels')
+    parser.add_argument('--num', type=int, default=14, help='the number of stops to list')
+    parser.add_argument('--since', type=datetime.date.fromisoformat,
+                        help='only count taps on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', type=datetime.date.fromisoformat,
+                        help='only count taps before this date (YYYY-MM-DD)')
+    parser.add_argument('--format', choices=list(img_encode.FORMATS), default=img_encode.IMG_FORMAT,
+                        help='format of the generated images (default: %s)' % (img_encode.IMG_FORMAT))
+    parser.add_argument('--compress-level', type=int,
+                        help='png compression level (0-9) or webp method (0-6): higher is smaller but slower')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip histories already processed by an earlier run into out_dir')
+    args = parser.parse_args(argv)
+
+    reports = [report.strip() for report in args.reports.split(',') if report.strip()]
+    for report in reports:
+        if report not in REPORTS:
+            parser.error("unknown report %s (reports: %s)" % (report, ', '.join(REPORTS)))
+
+    summary = run_batch(args.source, args.out_dir, reports, args.workers, args.width, args.num, args.resume,
+                        args.since, args.until, args.format, args.compress_level)
+    print("processed %d histories (%d failed, %d skipped) in %.1fs: %.1f histories/s, %d taps/s" %
+          (summary['ok'] + summary['failed'], summary['failed'], summary['skipped'], summary['seconds'],
+           summary['histories_per_s'] or 0, summary['taps_per_s'] or 0))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+import os, sys, json, time, random, argparse, datetime, platform, tempfile, tracemalloc
+import multiprocessing
+from statistics import median
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+import gtfs
+import retraceit as rt
+import img_encode
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is reported as None there
+    resource = None
+
+# feed sizes to benchmark against. translink is roughly the size of the real
+# TransLink feed; large is about four times that.
+PRESETS = {
+    'small':     {'routes': 20,  'trips_per_route': 50,  'stops': 500,   'stops_per_trip': 20},
+    'translink': {'routes': 240, 'trips_per_route': 250, 'stops': 8800,  'stops_per_trip': 40},
+    'large':     {'routes': 480, 'trips_per_route': 500, 'stops': 16000, 'stops_per_trip': 40},
+}
+# lengths of the generated compass histories, in months
+HISTORY_MONTHS = (1, 12, 60, 120)
+TAPS_PER_DAY   = 4
+
+# a result only counts as a regression if it is worse than the baseline by
+# more than the threshold (a fraction) AND by more than these absolute
+# amounts, so that noise in very fast stages does not fail the run. Times are
+# compared by their fastest run, which is the least noisy.
+DEFAULT_THRESHOLD = 0.15
+MIN_DELTA = {'wall_min_s': 0.02, 'peak_rss_mb': 2.0, 'alloc_peak_mb': 1.0}
+
+COMPASS_HEADER = ('DateTime,Transaction,Product,LineItem,Amount,BalanceDetails,JourneyId,'
+                  'LocationDisplay,TransactonTime,OrderDate,Payment,OrderNumber,AuthCode,Total')
+MONTH_NAMES = [month for month, _ in sorted(rt.MON_TO_NUM.items(), key=lambda item: item[1])]
+
+def gen_gtfs(gtfs_dir, routes=20, trips_per_route=50, stops=500, stops_per_trip=20, seed=1):
+    '''
+    Write a synthetic GTFS feed to gtfs_dir, with the given number of routes,
+    trips per route, stops and stops per trip (routes*trips_per_route*
+    stops_per_trip stop_times rows)
+        - the same arguments always produce the same files
+        - the feed has the quirks of the TransLink feed the parsers have to
+          handle: stations without a stop code, quoted names containing
+          commas, times past 24:00:00, drop-off only last stops and blank
+          distances
+        - trips run on weekdays, Saturdays or Sundays (services 1-3) for a
+          year, with a holiday running the Sunday service
+    '''
+    rnd = random.Random(seed)
+    os.makedirs(gtfs_dir, exist_ok=True)
+
+    def open_out(fname):
+        return open(os.path.join(gtfs_dir, fname), 'w', encoding='utf-8', newline='')
+
+    route_nums = []
+    with open_out('routes.txt') as fp:
+        fp.write('route_id,agency_id,route_short_name,route_long_name,route_desc,route_type,'
+                 'route_url,route_color,route_text_color\n')
+        for route in range(routes):
+            # mostly 3 digit bus routes, with some RapidBus and NightBus routes
+            kind = rnd.random()
+            num = 'R%d' % (route % 9 + 1) if kind < 0.04 else 'N%d' % (route % 35 + 1) if kind < 0.1 else '%03d' % (route + 1)
+            route_nums.append(num)
+            fp.write('%d,TL,%s,Route %s Long Name,,3,,%s,FFFFFF\n' % (6600 + route, num, num, '0A5A9C'))
+
+    with open_out('stops.txt') as fp:
+        fp.write('stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url,'
+                 'location_type,parent_station,wheelchair_boarding\n')
+        for stop in range(stops):
+            code = '' if rnd.random() < 0.02 else str(50000 + stop)
+            name = ('"Stop %d Bay %d, Loop"' % (stop, stop % 7) if rnd.random() < 0.05 else
+                    '%s @ %s St' % (rnd.choice(('Northbound', 'Southbound', 'Eastbound', 'Westbound')), 'Example %d' % (stop)))
+            fp.write('%d,%s,%s,,49.%06d,-123.%06d,BUS ZN,,0,,1\n' % (stop + 1, code, name,
+                                                                    rnd.randrange(10**6), rnd.randrange(10**6)))
+
+    with open_out('trips.txt') as trips_fp, open_out('stop_times.txt') as times_fp:
+        trips_fp.write('route_id,service_id,trip_id,trip_headsign,trip_short_name,direction_id,'
+                       'block_id,shape_id,wheelchair_accessible,bikes_allowed\n')
+        times_fp.write('trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,'
+                       'pickup_type,drop_off_type,shape_dist_traveled\n')
+        trip_id = 10**7
+        for route in range(routes):
+            route_stops = [rnd.randrange(stops) + 1 for _ in range(stops_per_trip)]
+            for trip in range(trips_per_route):
+                trip_id += 1
+                direction = trip % 2
+                trips_fp.write('%d,%d,%d,%s To Somewhere,,%d,%d,%d,1,1\n' % (6600 + route, rnd.randrange(3) + 1, trip_id,
+                                                                          route_nums[route], direction,
+                                                                          rnd.randrange(10**5), route * 2 + direction))
+                # spread trips from 4:30am to past 1am the next day
+                start = 4*3600 + 1800 + trip * (21*3600 // trips_per_route)
+                trip_stops = route_stops if direction == 0 else route_stops[::-1]
+                for seq, stop in enumerate(trip_stops):
+                    secs = start + seq * rnd.randrange(60, 150)
+                    stop_time = gtfs.format_gtfs_time(secs)
+                    last = seq == len(trip_stops) - 1
+                    times_fp.write('%d,%s,%s,%d,%d,,%d,0,%s\n' % (trip_id, stop_time, stop_time, stop, seq + 1,
+                                                                  1 if last else 0,
+                                                                  '' if seq == 0 else '%.4f' % (seq * 0.35)))
+
+    with open_out('calendar.txt') as fp:
+        fp.write('service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n')
+        for service, days in ((1, '1,1,1,1,1,0,0'), (2, '0,0,0,0,0,1,0'), (3, '0,0,0,0,0,0,1')):
+            fp.write('%d,%s,20250101,20251231\n' % (service, days))
+    with open_out('calendar_dates.txt') as fp:
+        fp.write('service_id,date,exception_type\n1,20250701,2\n3,20250701,1\n')
+
+def gen_compass_csv(months=12, stop_codes=None, taps_per_day=TAPS_PER_DAY, seed=1) -> str:
+    '''
+    Return the text of a synthetic Compass card history spanning the given
+    number of months, newest transaction first like real exports
+        - taps are spread over SkyTrain/SeaBus stations and the given bus stop
+          codes, with some purchase and load transactions mixed in
+        - the same arguments always produce the same text
+    '''
+    rnd = random.Random(seed)
+    stop_codes = stop_codes or [str(50000 + idx) for idx in range(500)]
+    # riders use a handful of stops most of the time
+    regular_stops = rnd.sample(stop_codes, min(len(stop_codes), 12))
+    stations = sorted(rt.STN_BULLETS)
+
+    rows = []
+    day = datetime.datetime(2014, 1, 1)
+    end = day + datetime.timedelta(days=round(months * 30.44))
+    balance = 50.0
+    order_num = 10**6
+    while day < end:
+        for _ in range(rnd.randrange(taps_per_day * 2 + 1)):
+            when = day + datetime.timedelta(minutes=rnd.randrange(300, 25*60 - 1) % (24*60))
+            stamp = '%s-%02d-%04d %02d:%02d %sM' % (MONTH_NAMES[when.month - 1], when.day, when.year,
+                                                     (when.hour % 12) or 12, when.minute,
+                                                     'P' if when.hour >= 12 else 'A')
+            kind = rnd.random()
+            auth_code = ''
+            if kind < 0.02:
+                order_num += 1
+                trans, amount = 'Loaded at %s' % (rnd.choice(stations)), 20.0
+                auth_code = 'A%06d' % (order_num)
+            elif kind < 0.03:
+                order_num += 1
+                trans, amount = 'Purchase', 0.0
+            elif kind < 0.55:
+                stop = rnd.choice(regular_stops) if rnd.random() < 0.8 else rnd.choice(stop_codes)
+                trans = '%s at Bus Stop %s' % (rnd.choice(('Tap in', 'Transfer')), stop)
+                amount = -rnd.choice((0, 2.5, 3.15))
+            else:
+                trans = '%s at %s' % (rnd.choice(('Tap in', 'Tap out', 'Transfer')), rnd.choice(stations))
+                amount = -rnd.choice((0, 2.5, 3.15, 4.55))
+            balance = max(0.0, balance + amount)
+            rows.append((when, '%s,%s,Stored Value,,%s$%.2f,$%.2f,%d,"%s\nStored Value",,,,%s,%s,' %
+                         (stamp, trans, '-' if amount < 0 else '', abs(amount), balance,
+                          len(rows), trans, order_num if auth_code else '', auth_code)))
+        day += datetime.timedelta(days=1)
+
+    rows.sort(key=lambda row: row[0], reverse=True)
+    return '\n'.join([COMPASS_HEADER] + [line for _, line in rows]) + '\n'
+
+def gen_bullets(img_dir):
+    '''
+    Write plain 54x54 bullets for every service in STN_BULLETS to img_dir, for
+    benchmarking without RETRACEIT_IMGDIR
+    '''
+    os.makedirs(img_dir, exist_ok=True)
+    for bullet in set([name for names in rt.STN_BULLETS.values() for name in names]):
+        img = Image.new('RGBA', (54, 54))
+        ImageDraw.Draw(img).ellipse((0, 0, 53, 53), fill=rt.BUS_COLOUR)
+        img.save(os.path.join(img_dir, bullet + '.png'))
+
+def prepare_data(data_dir, preset):
+    '''
+    Generate (or reuse, if already generated) the feed, histories and bullets
+    for preset under data_dir, and compile the feed's snapshot
+    '''
+    params = PRESETS[preset]
+    data_dir = os.path.join(data_dir, preset)
+    marker = os.path.join(data_dir, 'params.json')
+    if os.path.exists(marker):
+        with open(marker) as fp:
+            if json.load(fp) == params:
+                return data_dir
+
+    print("generating %s benchmark data in %s..." % (preset, data_dir))
+    gtfs_dir = os.path.join(data_dir, 'gtfs')
+    gen_gtfs(gtfs_dir, **params)
+    gtfs.compile_gtfs(gtfs_dir)
+
+    stop_codes = [str(50000 + idx) for idx in range(params['stops'])]
+    for months in HISTORY_MONTHS:
+        with open(os.path.join(data_dir, 'history_%dm.csv' % (months)), 'w', encoding='utf-8') as fp:
+            fp.write(gen_compass_csv(months, stop_codes, seed=months))
+    gen_bullets(os.path.join(data_dir, 'bullets'))
+
+    with open(marker, 'w') as fp:
+        json.dump(params, fp)
+    return data_dir
+
+# stages: name -> (setup, run). setup(data_dir) runs untimed in the stage's
+# process and returns the argument passed to run().
+def _read_history(data_dir, months):
+    with open(os.path.join(data_dir, 'history_%dm.csv' % (months)), encoding='utf-8') as fp:
+        return fp.read()
+
+def _load_db(data_dir):
+    os.environ['RETRACEIT_TRANSLINK_GTFSDIR'] = os.path.join(data_dir, 'gtfs')
+    os.environ.setdefault('RETRACEIT_IMGDIR', os.path.join(data_dir, 'bullets'))
+    db = rt.retraceit_db()
+    db.warm_up(background=False)
+    return db
+
+def _gen_img_setup(data_dir):
+    return rt.analyze_history(_read_history(data_dir, HISTORY_MONTHS[-1])), _load_db(data_dir)
+
+STAGES = {
+    'gtfs_parse':         (lambda data_dir: os.path.join(data_dir, 'gtfs'),
+                           lambda gtfs_dir: gtfs.parse_gtfs_dir(gtfs_dir)),
+    'gtfs_load_snapshot': (lambda data_dir: os.path.join(data_dir, 'gtfs'),
+                           lambda gtfs_dir: gtfs.read_gtfs_data(gtfs_dir)),
+    # the stop lines index as built when a feed has no snapshot
+    'stop_lines':         (lambda data_dir: gtfs.read_gtfs_data(os.path.join(data_dir, 'gtfs'))._replace(stop_lines=None),
+                           lambda gtfs_tup: gtfs.get_stop_lines_dict(gtfs_tup)),
+    # the departures index as built when a feed has no snapshot
+    'departures':         (lambda data_dir: gtfs.read_gtfs_data(os.path.join(data_dir, 'gtfs'))._replace(departures=None),
+                           lambda gtfs_tup: gtfs.get_departures(gtfs_tup)),
+    'gen_img':            (_gen_img_setup,
+                           lambda args: rt.stop_stats_img(*args, width=1050, num=14)),
+    'all_stats_imgs':     (_gen_img_setup,
+                           lambda args: rt.stats_imgs(*args)),
+    'route_stats_img':    (_gen_img_setup,
+                           lambda args: rt.route_stats_img(*args, width=1050, num=14)),
+    'encode_png':         (lambda data_dir: rt.stop_stats_img(*_gen_img_setup(data_dir), width=1050, num=14),
+                           lambda img: img_encode.encode(img, 'png')),
+    'encode_webp':        (lambda data_dir: rt.stop_stats_img(*_gen_img_setup(data_dir), width=1050, num=14),
+                           lambda img: img_encode.encode(img, 'webp')),
+}
+# stages that draw text, and need RETRACEIT_FNTFILE
+IMG_STAGES = ('gen_img', 'all_stats_imgs', 'route_stats_img', 'encode_png', 'encode_webp')
+for _months in HISTORY_MONTHS:
+    STAGES['load_csv_%dm' % (_months)] = (lambda data_dir, months=_months: _read_history(data_dir, months),
+                                          rt.load_csv)
+    STAGES['analyze_%dm' % (_months)]  = (lambda data_dir, months=_months: _read_history(data_dir, months),
+                                          rt.analyze_history)
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+def _run_stage(name, data_dir, repeat, trace_allocs):
+    '''
+    Run a stage in the current (fresh) process, returning its metrics
+    '''
+    setup, run = STAGES[name]
+    arg = setup(data_dir)
+
+    if trace_allocs:
+        tracemalloc.start()
+        run(arg)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'alloc_peak_mb': peak / (1 << 20), 'alloc_retained_mb': current / (1 << 20)}
+
+    rss_before = _peak_rss_mb()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - start)
+
+    return {'wall_s': median(times), 'wall_min_s': min(times), 'repeat': repeat,
+            'peak_rss_mb': _peak_rss_mb(), 'setup_rss_mb': rss_before}
+
+def run_stage(name, data_dir, repeat=3, trace_allocs=True) -> dict:
+    '''
+    Benchmark a stage, returning its metrics
+        - the stage runs in a new process, so peak RSS is that of the stage
+          (plus its setup) alone
+        - allocations are traced in a separate run, since tracing slows the
+          stage down and adds to its RSS
+    '''
+    mp_context = multiprocessing.get_context('spawn')
+    metrics = {}
+    for trace in ((False, True) if trace_allocs else (False,)):
+        with ProcessPoolExecutor(1, mp_context=mp_context) as pool:
+            metrics.update(pool.submit(_run_stage, name, data_dir, repeat, trace).result())
+    return metrics
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD) -> list[str]:
+    '''
+    Return a description of every metric in results that regressed against
+    baseline by more than threshold (a fraction, e.g. 0.15 for 15%)
+    '''
+    regressions = []
+    for name, metrics in results['stages'].items():
+        base_metrics = baseline['stages'].get(name)
+        if not base_metrics:
+            continue
+        for metric, min_delta in MIN_DELTA.items():
+            new, old = metrics.get(metric), base_metrics.get(metric)
+            if new is None or old is None:
+                continue
+            if new > old * (1 + threshold) and new - old > min_delta:
+                regressions.append('%s %s: %.3f -> %.3f (+%.0f%%)' % (name, metric, old, new,
+                                                                      (new / old - 1) * 100 if old else float('inf')))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Retraceit against synthetic GTFS feeds and Compass histories.')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small',
+                        help='size of the generated GTFS feed (default: small)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (default: 3)')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'retraceit-bench'),
+                        help='where generated data is kept between runs')
+    parser.add_argument('--no-allocs', action='store_true', help='skip tracing allocations')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='fail if results regress against this results file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed regression, as a fraction (default: %.2f)' % (DEFAULT_THRESHOLD))
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("unknown stage %s (stages: %s)" % (stage, ', '.join(STAGES)))
+
+    if any([stage in IMG_STAGES for stage in stages]) and not os.environ.get('RETRACEIT_FNTFILE'):
+        print("RETRACEIT_FNTFILE is not set, skipping image stages")
+        stages = [stage for stage in stages if stage not in IMG_STAGES]
+
+    data_dir = prepare_data(args.data_dir, args.preset)
+    results = {'preset': args.preset, 'params': PRESETS[args.preset],
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'date': datetime.datetime.now().isoformat(timespec='seconds'), 'stages': {}}
+
+    print("%-20s %10s %10s %12s" % ('stage', 'wall (s)', 'rss (MB)', 'allocs (MB)'))
+    for stage in stages:
+        metrics = run_stage(stage, data_dir, args.repeat, not args.no_allocs)
+        results['stages'][stage] = metrics
+        print("%-20s %10.3f %10s %12s" % (stage, metrics['wall_s'],
+                                          '%.1f' % metrics['peak_rss_mb'] if metrics['peak_rss_mb'] is not None else '-',
+                                          '%.1f' % metrics['alloc_peak_mb'] if 'alloc_peak_mb' in metrics else '-'))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline.get('params') != results['params']:
+            print("warning: baseline was run with a different feed size (%s)" % (baseline.get('preset')))
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            return 1
+        print("no regressions against %s" % (args.baseline))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
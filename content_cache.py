@@ -0,0 +1,72 @@
+import hashlib, threading
+from collections import OrderedDict
+
+def content_hash(data: bytes) -> str:
+    '''
+    Return the key identifying an uploaded file by its contents
+    '''
+    return hashlib.sha256(data).hexdigest()
+
+class lru_store:
+    '''
+    Thread-safe mapping that evicts its least recently used entries once the
+    total size of its values exceeds max_size
+        - sizeof(value) gives the size of each value (default: 1, so max_size
+          bounds the number of entries). A value larger than max_size is not
+          stored at all.
+        - hits/misses count the results of get()
+    '''
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof   = sizeof or (lambda value: 1)
+        self.size     = 0
+        self.hits     = 0
+        self.misses   = 0
+
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        value_size = self.sizeof(value)
+        if value_size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, value_size)
+            self.size += value_size
+
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard_if(self, predicate) -> int:
+        '''
+        Remove the entries whose key predicate(key) is true for, returning
+        how many were removed
+        '''
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self.size -= self._entries.pop(key)[1]
+        return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self.size, 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,164 +1,1361 @@
-import os, io
+import os, io, sys, csv, json, mmap, struct, hashlib, datetime, tempfile, threading
+from array import array
+from bisect import bisect_left, bisect_right
+from math import nan as NAN
+from operator import itemgetter
 from collections import namedtuple
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
 
 StopTime = namedtuple('StopTime', ['trip_id', 'arr_time', 'dep_time', 'stop_id', 'stop_seq', 'pickup_type', 'dropoff_type', 'dist'])
 # to be enhanced
-StopInfo = namedtuple('Stop', ['code', 'name'])
+StopInfo = namedtuple('StopInfo', ['code', 'name'])
 Trip = namedtuple('Trip', ['rt_id', 'service_id', 'block_id', 'shape_id', 'direction', 'wheelchair', 'bike'])
-RouteInfo = namedtuple('Route', ['num', 'name', 'type', 'colour', 'txt_colour'])
-GTFS = namedtuple('GTFS', ['routes', 'trips', 'stops', 'stoptimes', 'stop_id_to_code'])
+RouteInfo = namedtuple('RouteInfo', ['num', 'name', 'type', 'colour', 'txt_colour'])
+# stop_lines: {include_dropoff_only: {stop_code: [route nums]}}, see
+# build_stop_lines_index(), departures: see build_departures_index(), and
+# calendar: see build_service_calendar() (None if the feed has no calendar)
+GTFS = namedtuple('GTFS', ['routes', 'trips', 'stops', 'stoptimes', 'stop_id_to_code',
+                           'stop_lines', 'departures', 'calendar'], defaults=(None, None, None))
+
+# compiled snapshots of a gtfs directory, see write_gtfs_snapshot()
+SNAPSHOT_MAGIC   = b'RTGTFS\x00\x00'
+SNAPSHOT_VERSION = 6
+SNAPSHOT_FNAME   = 'retraceit.snapshot'
+GTFS_FILES       = ('routes.txt', 'trips.txt', 'stops.txt', 'stop_times.txt')
+# feeds have either or both of these
+CALENDAR_FILES   = ('calendar.txt', 'calendar_dates.txt')
+
+# size of the chunks gtfs files are streamed in
+CSV_BUFFER_SIZE = 1 << 20
+
+# parallel ingest (see parse_gtfs_dir): number of worker processes, and the
+# maximum size of the byte ranges stop_times.txt is split into
+GTFS_WORKERS        = int(os.environ.get('RETRACEIT_GTFS_WORKERS', 1))
+STOPTIMES_CHUNK_MAX = 64 << 20
+
+class StringPool:
+    '''
+    Canonical copies of strings, so that values repeated within a feed (service
+    ids, directions, ...) and across feeds (route numbers, stop names, ...) are
+    only stored once however many feeds are loaded
+        - each loaded feed interns its strings through its own owner() (see
+          PooledStrings), and the pool counts how many owners hold each string
+        - a string is dropped from the pool once the last owner holding it is
+          released, e.g. when the feeds using it are unloaded
+    '''
+    def __init__(self):
+        # string: [canonical copy, number of owners]
+        self._strings = {}
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._strings)
+
+    def owner(self) -> 'PooledStrings':
+        return PooledStrings(self)
+
+    def interned(self, string) -> bool:
+        '''
+        Return whether string is the pool's copy of its value
+        '''
+        entry = self._strings.get(string)
+        return entry is not None and entry[0] is string
+
+    def size(self) -> int:
+        '''
+        Return the number of bytes taken by the pooled strings
+        '''
+        return sum([sys.getsizeof(string) for string in list(self._strings)])
+
+    def _acquire(self, string) -> str:
+        # called with self._lock held
+        entry = self._strings.get(string)
+        if entry is None:
+            entry = self._strings[string] = [string, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release(self, strings):
+        with self._lock:
+            for string in strings:
+                entry = self._strings[string]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._strings[string]
+
+class PooledStrings:
+    '''
+    The strings one loaded feed holds in a StringPool
+        - intern(string) returns the pool's copy of string, adding it first if
+          needed, and records that this owner holds it
+        - release() gives all of them back to the pool, e.g. once the feed is
+          unloaded. The owner can be used again afterwards.
+        - without a pool, strings are only shared within the owner
+    '''
+    def __init__(self, pool: StringPool = None):
+        self.pool     = pool
+        self._strings = {}
+
+    def intern(self, string) -> str:
+        interned = self._strings.get(string)
+        if interned is not None:
+            return interned
+        if self.pool is None:
+            return self._strings.setdefault(string, string)
+
+        with self.pool._lock:
+            interned = self._strings.get(string)
+            if interned is None:
+                interned = self._strings[string] = self.pool._acquire(string)
+        return interned
+
+    def release(self):
+        if self.pool is not None:
+            with self.pool._lock:
+                strings, self._strings = self._strings, {}
+            self.pool._release(strings)
+        else:
+            self._strings = {}
+
+# shared by every feed loaded in the process
+STRINGS = StringPool()
+
+def open_gtfs_file(gtfs_dir, fname):
+    '''
+    Open a GTFS text file for reading with read_csv_rows, buffered in
+    CSV_BUFFER_SIZE chunks
+    '''
+    # GTFS files are utf-8, and may start with a BOM that would otherwise end
+    # up in the first column name
+    return open(os.path.join(gtfs_dir, fname), encoding='utf-8-sig', newline='',
+                buffering=CSV_BUFFER_SIZE)
+
+def read_csv_rows(fp, columns, required=()):
+    '''
+    Stream the records of a csv file with a header line (RFC 4180 quoting),
+    yielding a tuple of the values of the given columns for each record
+        - fp may be either a file pointer (opened with newline=''), or a
+          string containing the text of a csv file
+        - columns are looked up by name in the header, so files with extra or
+          reordered columns are read correctly. Columns that are not in the
+          file read as ''; a ValueError is raised if any of the required
+          columns are missing.
+        - at least two columns must be requested
+    '''
+    reader = csv.reader(io.StringIO(fp) if isinstance(fp, str) else fp)
+    header = [name.strip() for name in next(reader, [])]
+
+    for name in required:
+        if name not in header:
+            raise ValueError("csv file is missing the %s column" % (name))
+
+    # missing columns are mapped to a padding value past the end of the row
+    width = len(header)
+    getter = itemgetter(*[header.index(name) if name in header else width for name in columns])
+
+    for row in reader:
+        if len(row) <= width:
+            # skip blank lines, and treat missing trailing values as blank
+            if not row:
+                continue
+            row += [''] * (width + 1 - len(row))
+        yield getter(row)
 
 def grab_csv_lines(fp) -> list[str]:
     '''
     parse lines from csv, skipping newlines in quotes
         - fp may be either a file pointer, or a string containing the text of a 
           csv file
+        - this loads the whole file; prefer read_csv_rows for new code
     '''
-    # TODO: is there a faster/better alogirhtm for this?
     contents = fp.read() if type(fp) == io.TextIOWrapper else fp
-    flen = len(contents)
-    idx = next_newline = 0
-    inverb = False
-
     results = []
 
-    while idx < flen:
-        cur_idx = idx 
+    # a newline ends a record unless it is inside quotes. Once a quote is
+    # closed, any further quotes on that line are ignored. Blank lines are not
+    # records of their own, but are kept at the start of the next record.
+    record, in_quotes = None, False
+    for line in contents.split('\n'):
+        record = line if record is None else record + '\n' + line
+        quotes = line.count('"')
+        in_quotes = quotes == 0 if in_quotes else quotes == 1
+        if record and not in_quotes:
+            results.append(record)
+            record = None
 
-        while (inverb or next_newline <= idx) and (next_newline != flen or next_quote != flen):
-            next_newline = contents.find("\n", cur_idx)
-            if next_newline == -1: next_newline = flen
-            next_quote = contents.find('"', cur_idx)
-            if next_quote == -1: next_quote = flen
-            inverb = not inverb if next_quote <= next_newline and next_quote < flen else inverb
-            cur_idx = min(next_quote, next_newline) +1
+    if record:
+        # unterminated quote
+        results.append(record)
 
-        results.append(contents[idx:next_newline])
+    return results
 
-        idx = next_newline + 1
+def iter_csv_lines(fp):
+    '''
+    Yield the records of a csv one at a time, split as grab_csv_lines does, so
+    that a caller only interested in the first few doesn't split the rest
+        - slower than grab_csv_lines when every record is read
+    '''
+    lines = fp if type(fp) == io.TextIOWrapper else io.StringIO(fp, newline='\n')
 
-    return results
+    record, in_quotes, ended = None, False, True
+    for line in lines:
+        ended = line.endswith('\n')
+        line = line[:-1] if ended else line
+        record = line if record is None else record + '\n' + line
+        quotes = line.count('"')
+        in_quotes = quotes == 0 if in_quotes else quotes == 1
+        if record and not in_quotes:
+            yield record
+            record = None
+
+    # like str.split, text ending in a newline has an empty last line
+    if ended:
+        record = '' if record is None else record + '\n'
+    if record:
+        # unterminated quote
+        yield record
+
+def read_gtfs_data(gtfs_dir, snapshot_path=None, use_snapshot=True, workers=None, strings=None):
+    '''
+    Load the GTFS feed in gtfs_dir, returning a GTFS tuple
+        - if use_snapshot is set, the feed is loaded from the compiled snapshot
+          at snapshot_path (default: gtfs_dir/retraceit.snapshot) when it is
+          up to date with the text files. Otherwise, the text files are parsed
+          and the snapshot is (re)compiled for the next load.
+        - workers is the number of processes used to parse the text files (see
+          parse_gtfs_dir)
+        - strings (a PooledStrings, e.g. STRINGS.owner()) holds the strings of
+          the feed, see parse_gtfs_dir and load_gtfs_snapshot
+    '''
+    if not use_snapshot:
+        return parse_gtfs_dir(gtfs_dir, workers, strings)
+
+    snapshot_path = snapshot_path or os.path.join(gtfs_dir, SNAPSHOT_FNAME)
+    fingerprint = gtfs_fingerprint(gtfs_dir)
+
+    gtfs_tup = load_gtfs_snapshot(snapshot_path, fingerprint, strings)
+    if gtfs_tup:
+        print("loaded gtfs snapshot: %s" % (snapshot_path))
+        return gtfs_tup
+
+    gtfs_tup = parse_gtfs_dir(gtfs_dir, workers, strings)
+    try:
+        write_gtfs_snapshot(gtfs_tup, snapshot_path, fingerprint)
+    except OSError as e:
+        print("could not write gtfs snapshot %s: %s" % (snapshot_path, e))
+        return gtfs_tup
 
-def read_gtfs_data(gtfs_dir):
+    # serve the feed from the mapped snapshot rather than keeping the parsed
+    # copy alive
+    mapped_tup = load_gtfs_snapshot(snapshot_path, fingerprint, strings)
+    if mapped_tup is None:
+        return gtfs_tup
+    # the mapped copy interns its strings as they are read, so those of the
+    # parsed copy can all be given back
+    if strings is not None:
+        strings.release()
+    return mapped_tup
+
+def gtfs_footprint(gtfs_tup) -> int:
+    '''
+    Return roughly how many bytes of memory the GTFS tuple holds on to
+        - for a feed loaded from a snapshot, the size of the mapped file (its
+          pages are only resident once read, so this is an upper bound)
+        - for a parsed feed, the size of its tables, columns and indexes.
+          Strings interned in STRINGS are shared with other feeds, so they are
+          not counted.
     '''
+    if isinstance(gtfs_tup.routes, MappedTable):
+        return len(gtfs_tup.routes.pool.data.obj)
+
+    size, seen = 0, set()
+    todo = list(gtfs_tup)
+    while todo:
+        obj = todo.pop()
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, str):
+            if not STRINGS.interned(obj):
+                size += sys.getsizeof(obj)
+        elif isinstance(obj, (array, bytes, bytearray)):
+            size += sys.getsizeof(obj)
+        elif isinstance(obj, memoryview):
+            size += obj.nbytes
+        elif isinstance(obj, dict):
+            size += sys.getsizeof(obj)
+            todo += obj.keys()
+            todo += obj.values()
+        elif isinstance(obj, (list, tuple)):
+            size += sys.getsizeof(obj)
+            todo += obj
+        elif isinstance(obj, (StopTimes, Departures, ServiceCalendar)):
+            todo += vars(obj).values()
+    return size
+
+def parse_gtfs_dir(gtfs_dir, workers=None, strings=None):
     '''
+    Parse the GTFS text files in gtfs_dir, returning a GTFS tuple
+        - with workers > 1 (default: RETRACEIT_GTFS_WORKERS, or 1), the files
+          are parsed in a pool of that many processes: routes, trips and stops
+          in parallel with stop_times, which is split into byte ranges on line
+          boundaries. The result is identical to parsing serially.
+          Worker processes are forked, so they are only used when no other
+          thread is running (e.g. from `python3 gtfs.py` or batch.py): a
+          child forked while another thread holds a lock would deadlock on it.
+          Otherwise, e.g. in the bot, the files are parsed serially.
+        - strings (a PooledStrings, e.g. STRINGS.owner()) interns the values
+          repeated within and across feeds. Without it, or for the files
+          parsed by worker processes, they are only shared within the feed.
+    '''
+    workers = workers or GTFS_WORKERS
     print("reading gtfs data: %s" % (gtfs_dir))
-    with open(os.path.join(gtfs_dir, 'routes.txt')) as rts_fp:
-        routes = get_routes_dict(rts_fp)
+    if workers > 1 and threading.active_count() > 1:
+        print("parsing %s serially: worker processes can't be forked while other threads are running" % (gtfs_dir))
+        workers = 1
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            routes_ftr = pool.submit(_parse_gtfs_file, gtfs_dir, 'routes.txt', get_routes_dict)
+            trips_ftr  = pool.submit(_parse_gtfs_file, gtfs_dir, 'trips.txt', get_trips_dict)
+            stops_ftr  = pool.submit(_parse_gtfs_file, gtfs_dir, 'stops.txt', read_gtfs_stops)
+            cal_ftr    = pool.submit(read_gtfs_calendar, gtfs_dir)
+            chunk_ftrs = [pool.submit(_parse_stoptimes_range, gtfs_dir, start, end)
+                          for start, end in _stoptimes_ranges(gtfs_dir, workers)]
+
+            routes = routes_ftr.result()
+            trips = trips_ftr.result()
+            stops, stop_id_to_code = stops_ftr.result()
+            calendar, calendar_dates = cal_ftr.result()
 
-    with open(os.path.join(gtfs_dir, 'trips.txt')) as trips_fp:
-        trips = get_trips_dict(trips_fp)
+            # merge in file order, so ids are interned in the same order as
+            # when reading serially
+            stoptimes = StopTimes()
+            for chunk_ftr in chunk_ftrs:
+                stoptimes.extend(chunk_ftr.result())
+    else:
+        with open_gtfs_file(gtfs_dir, 'routes.txt') as rts_fp:
+            routes = get_routes_dict(rts_fp, strings)
 
-    with open(os.path.join(gtfs_dir, 'stops.txt')) as stops_fp:
-        stops, stop_id_to_code = read_gtfs_stops(stops_fp)
+        with open_gtfs_file(gtfs_dir, 'trips.txt') as trips_fp:
+            trips = get_trips_dict(trips_fp, strings)
 
-    with open(os.path.join(gtfs_dir, 'stop_times.txt')) as stoptms_fp:
-        stoptimes = get_stoptimes(stoptms_fp)
+        with open_gtfs_file(gtfs_dir, 'stops.txt') as stops_fp:
+            stops, stop_id_to_code = read_gtfs_stops(stops_fp, strings)
+
+        with open_gtfs_file(gtfs_dir, 'stop_times.txt') as stoptms_fp:
+            stoptimes = get_stoptimes(stoptms_fp)
+
+        calendar, calendar_dates = read_gtfs_calendar(gtfs_dir)
+    stoptimes.link_trips(trips)
+
+    gtfs_tup = GTFS(routes, trips, stops, stoptimes, stop_id_to_code)
+    gtfs_tup = gtfs_tup._replace(stop_lines=build_stop_lines_index(gtfs_tup),
+                                 departures=build_departures_index(gtfs_tup))
+    gtfs_tup = gtfs_tup._replace(calendar=build_service_calendar(gtfs_tup, calendar, calendar_dates))
 
     print("finished reading gtfs data in %s" % (gtfs_dir))
-    return GTFS(routes, trips, stops, stoptimes, stop_id_to_code)
+    return gtfs_tup
+
+def _parse_gtfs_file(gtfs_dir, fname, parse_func):
+    with open_gtfs_file(gtfs_dir, fname) as fp:
+        return parse_func(fp)
+
+def _stoptimes_ranges(gtfs_dir, workers):
+    '''
+    Split the body of stop_times.txt into at least one byte range per worker
+    (of at most STOPTIMES_CHUNK_MAX bytes), each starting at the beginning of
+    a line and ending after a newline
+        - assumes no quoted values in stop_times.txt contain newlines
+    '''
+    path = os.path.join(gtfs_dir, 'stop_times.txt')
+    size = os.path.getsize(path)
+    ranges = []
+
+    with open(path, 'rb') as fp:
+        fp.readline()
+        start = fp.tell()
+        num_chunks = max(workers, -(-(size - start) // STOPTIMES_CHUNK_MAX))
+        chunk_size = -(-(size - start) // num_chunks)
+
+        while start < size:
+            fp.seek(start + chunk_size)
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+def _parse_stoptimes_range(gtfs_dir, start, end) -> 'StopTimes':
+    with open(os.path.join(gtfs_dir, 'stop_times.txt'), 'rb') as fp:
+        header = fp.readline()
+        fp.seek(start)
+        body = fp.read(end - start)
+
+    return get_stoptimes(io.StringIO((header + body).decode('utf-8-sig'), newline=''))
+
+def compile_gtfs(gtfs_dir, snapshot_path=None, workers=None):
+    '''
+    Parse the GTFS feed in gtfs_dir and write its snapshot to snapshot_path
+    (default: gtfs_dir/retraceit.snapshot), regardless of whether an up to
+    date snapshot already exists
+    '''
+    snapshot_path = snapshot_path or os.path.join(gtfs_dir, SNAPSHOT_FNAME)
+    write_gtfs_snapshot(parse_gtfs_dir(gtfs_dir, workers), snapshot_path,
+                        gtfs_fingerprint(gtfs_dir))
+    return snapshot_path
+
+def gtfs_fingerprint(gtfs_dir) -> str:
+    '''
+    Return a hash identifying the current version of the GTFS files in
+    gtfs_dir. The hash covers the size and modification time of each file, so
+    it can be computed without reading the (large) files themselves.
+    '''
+    fingerprint = hashlib.sha1(b'%d;' % SNAPSHOT_VERSION)
+    for fname in GTFS_FILES + CALENDAR_FILES:
+        path = os.path.join(gtfs_dir, fname)
+        if fname in CALENDAR_FILES and not os.path.exists(path):
+            fingerprint.update(b'%s:missing;' % (fname.encode()))
+            continue
+        st = os.stat(path)
+        fingerprint.update(b'%s:%d:%d;' % (fname.encode(), st.st_size, st.st_mtime_ns))
+
+    return fingerprint.hexdigest()
+
+def write_gtfs_snapshot(gtfs_tup, path, fingerprint):
+    '''
+    Compile the given GTFS tuple into a snapshot file at path. Layout:
+        - 8 byte magic, then the format version and header length as uint32s
+        - a JSON header holding the source fingerprint, the location of each
+          section, relative to the (8-byte aligned) end of the header, and how
+          each table is encoded
+        - sections: a pool of every string in the tables, the routes, trips,
+          stops, stop_id_to_code and stop_lines tables (see MappedTable), the
+          stop_times trip/stop/route ids, one column per StopTime field, the
+          departures index (see Departures) and the service calendar (see
+          ServiceCalendar), if the feed has one
+    Everything is read in place from the mapped file, so any number of
+    processes loading the same snapshot share a single copy of the feed. The
+    file is written to a unique temporary file in the same directory and moved
+    into place, so readers never see a partial snapshot, even while several
+    processes compile it at once.
+    '''
+    stoptimes = gtfs_tup.stoptimes
+    stop_lines = gtfs_tup.stop_lines or build_stop_lines_index(gtfs_tup)
+    departures = gtfs_tup.departures or build_departures_index(gtfs_tup)
+    pool, pool_idx = [], {}
+    sections, tables = [], {}
+
+    for name, table, row_type in (('routes', gtfs_tup.routes, RouteInfo), ('trips', gtfs_tup.trips, Trip),
+                                  ('stops', gtfs_tup.stops, StopInfo),
+                                  ('stop_id_to_code', gtfs_tup.stop_id_to_code, str),
+                                  ('stop_lines_pickup', stop_lines[False], list),
+                                  ('stop_lines_all', stop_lines[True], list)):
+        tables[name] = row_type.__name__
+        sections += _table_sections(name, table, row_type, pool, pool_idx)
+
+    sections += _string_sections('strings', pool)
+    for name in ('trip_ids', 'stop_ids', 'route_ids'):
+        sections += _string_sections('st_' + name, getattr(stoptimes, name))
+    sections += [('st_' + name, StopTimes.COLUMNS[name], col.tobytes())
+                 for name, col in stoptimes.columns().items()]
+    sections += _string_sections('dep_stop_codes', departures.stop_codes)
+    sections += [('dep_' + name, Departures.COLUMNS[name], getattr(departures, name).tobytes())
+                 for name in Departures.COLUMNS]
+
+    calendar = gtfs_tup.calendar
+    if calendar:
+        sections += _string_sections('cal_service_ids', calendar.service_ids)
+        sections += [('cal_' + name, ServiceCalendar.COLUMNS[name], bytes(getattr(calendar, name)))
+                     for name in ServiceCalendar.COLUMNS]
+
+    header = {'fingerprint': fingerprint, 'tables': tables, 'sections': {},
+              'calendar': {'start': calendar.start, 'service_width': calendar.service_width,
+                           'route_width': calendar.route_width} if calendar else None}
+    offset = 0
+    for name, typecode, data in sections:
+        header['sections'][name] = [offset, len(data), typecode]
+        offset += _align8(len(data))
+    header = json.dumps(header).encode()
+
+    # a unique temporary file, so processes compiling the same feed at once
+    # don't write over each other's; the last one moved into place wins
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path) or '.')
+    try:
+        # mkstemp files are only readable by their owner
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(SNAPSHOT_MAGIC + struct.pack('<II', SNAPSHOT_VERSION, len(header)) + header)
+            fp.write(b'\x00' * (_align8(fp.tell()) - fp.tell()))
+            for _, _, data in sections:
+                fp.write(data)
+                fp.write(b'\x00' * (_align8(len(data)) - len(data)))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    print("wrote gtfs snapshot: %s" % (path))
+
+def load_gtfs_snapshot(path, fingerprint=None, strings=None):
+    '''
+    Memory-map the snapshot at path and return its GTFS tuple, or None if the
+    snapshot is missing, was written by another format version, does not
+    match the given source fingerprint, or is corrupt (e.g. truncated)
+        - the tables are MappedTables, and the StopTimes ids and columns views
+          of the mapped file, rather than copies: loading does not depend on
+          the feed size, and processes loading the same snapshot share its
+          pages instead of each holding their own copy
+        - the values of the tables are decoded once, as they are read, and
+          interned in strings (a PooledStrings), if given
+    '''
+    try:
+        with open(path, 'rb') as fp:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # ValueError: mmap of an empty file
+        return None
+
+    try:
+        return _map_gtfs_snapshot(mapped, fingerprint, strings)
+    except (struct.error, ValueError, KeyError, TypeError) as e:
+        # ValueError includes json.JSONDecodeError and UnicodeDecodeError
+        print("ignoring corrupt gtfs snapshot %s: %s: %s" % (path, type(e).__name__, e))
+        return None
+
+def _map_gtfs_snapshot(mapped, fingerprint, strings):
+    '''
+    Return the GTFS tuple of the mapped snapshot (see load_gtfs_snapshot), or
+    None if it is outdated. Raises struct.error, ValueError, KeyError or
+    TypeError if the snapshot is corrupt.
+    '''
+    if mapped[:8] != SNAPSHOT_MAGIC:
+        return None
+    version, header_len = struct.unpack_from('<II', mapped, 8)
+    if version != SNAPSHOT_VERSION:
+        return None
+    header = json.loads(mapped[16:16 + header_len])
+    if fingerprint and header['fingerprint'] != fingerprint:
+        return None
+
+    data_start = _align8(16 + header_len)
+    view = memoryview(mapped)
+
+    def section(name):
+        offset, length, typecode = header['sections'][name]
+        if data_start + offset + length > len(view):
+            raise ValueError("section %s past the end of the file" % (name))
+        data = view[data_start + offset:data_start + offset + length]
+        return data.cast(typecode) if typecode else data
+
+    if strings is None:
+        strings = PooledStrings()
+
+    def string_list(name, interned=False):
+        return MappedStrings(section(name), section(name + '_offsets'), strings if interned else None)
+
+    # the values of the tables: route numbers, stop names, service ids...
+    pool = string_list('strings', interned=True)
+    tables = {}
+    for name, row_type in header['tables'].items():
+        tables[name] = MappedTable(string_list(name + '_keys'), section(name + '_values'), pool,
+                                   MAPPED_ROW_TYPES[row_type],
+                                   section(name + '_value_offsets') if row_type == 'list' else None)
+
+    stoptimes = StopTimes(string_list('st_trip_ids'), string_list('st_stop_ids'), string_list('st_route_ids'),
+                          {name: section('st_' + name) for name in StopTimes.COLUMNS})
+
+    departures = Departures(string_list('dep_stop_codes'), stoptimes,
+                            *[section('dep_' + name) for name in Departures.COLUMNS])
+
+    calendar = None
+    if header['calendar']:
+        calendar = ServiceCalendar(string_list('cal_service_ids'), departures,
+                                   *[section('cal_' + name) for name in ServiceCalendar.COLUMNS],
+                                   **header['calendar'])
+
+    return GTFS(tables['routes'], tables['trips'], tables['stops'], stoptimes, tables['stop_id_to_code'],
+                {False: tables['stop_lines_pickup'], True: tables['stop_lines_all']}, departures, calendar)
+
+def _align8(n):
+    return (n + 7) & ~7
+
+def _string_sections(name, strings) -> list:
+    '''
+    Return the sections storing a list of strings as a MappedStrings: their
+    utf-8 data, and the offset of each string in it (plus the end of the last)
+    '''
+    data = [string.encode('utf-8') for string in strings]
+    offsets = array('Q', [0])
+    for string in data:
+        offsets.append(offsets[-1] + len(string))
+    return [(name, '', b''.join(data)), (name + '_offsets', 'Q', offsets.tobytes())]
+
+def _table_sections(name, table, row_type, pool, pool_idx) -> list:
+    '''
+    Return the sections storing a dict with string keys as a MappedTable: its
+    sorted keys, and its values as indices into the string pool. Values are
+    either strings (row_type str), tuples of strings (row_type is the
+    namedtuple type), or lists of strings (row_type list; the offset of each
+    key's values is stored too).
+    '''
+    keys = sorted(table, key=lambda key: key.encode('utf-8'))
+    values = array('I')
+    value_offsets = array('Q', [0])
+    for key in keys:
+        value = table[key]
+        for string in ((value,) if row_type is str else value):
+            idx = pool_idx.get(string)
+            if idx is None:
+                idx = pool_idx[string] = len(pool)
+                pool.append(string)
+            values.append(idx)
+        value_offsets.append(len(values))
+
+    sections = _string_sections(name + '_keys', keys) + [(name + '_values', 'I', values.tobytes())]
+    if row_type is list:
+        sections.append((name + '_value_offsets', 'Q', value_offsets.tobytes()))
+    return sections
+
+class MappedStrings(Sequence):
+    '''
+    Read-only list of strings stored in a snapshot (see _string_sections):
+    each string is decoded from the mapped file when it is accessed
+        - if strings (a PooledStrings) is given, each string is only decoded
+          once, and interned in strings
+    '''
+    def __init__(self, data, offsets, strings=None):
+        self.data    = data
+        self.offsets = offsets
+        self.strings = strings
+        self.decoded = {} if strings is not None else None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("string index out of range")
+        if self.decoded is None:
+            return str(self.data[self.offsets[idx]:self.offsets[idx + 1]], 'utf-8')
+
+        string = self.decoded.get(idx)
+        if string is None:
+            string = self.decoded[idx] = self.strings.intern(str(self.data[self.offsets[idx]:self.offsets[idx + 1]],
+                                                                 'utf-8'))
+        return string
+
+    def raw(self, idx) -> bytes:
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes()
+
+class MappedTable(Mapping):
+    '''
+    Read-only dict stored in a snapshot (see _table_sections)
+        - keys are looked up by binary search over the sorted keys, and values
+          built from the string pool when they are accessed. Iteration is in
+          key order.
+        - row_type is the type of the values: str, a namedtuple type, or list
+          (in which case value_offsets locates each key's values)
+    '''
+    def __init__(self, keys, values, pool, row_type, value_offsets=None):
+        self.key_strings    = keys
+        self.value_ids      = values
+        self.pool           = pool
+        self.row_type       = row_type
+        self.value_offsets  = value_offsets
+        self.width          = 1 if row_type in (str, list) else len(row_type._fields)
+
+    def _find(self, key) -> int:
+        if not isinstance(key, str):
+            return -1
+        target = key.encode('utf-8')
+        keys = self.key_strings
+        lo, hi = 0, len(keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys.raw(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(keys) and keys.raw(lo) == target else -1
+
+    def _value(self, idx):
+        pool = self.pool
+        if self.row_type is str:
+            return pool[self.value_ids[idx]]
+        if self.row_type is list:
+            return [pool[value] for value in self.value_ids[self.value_offsets[idx]:self.value_offsets[idx + 1]]]
+        width = self.width
+        return self.row_type._make([pool[value] for value in self.value_ids[idx*width:(idx + 1)*width]])
+
+    def __getitem__(self, key):
+        idx = self._find(key)
+        if idx < 0:
+            raise KeyError(key)
+        return self._value(idx)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return len(self.key_strings)
 
+    def __iter__(self):
+        return iter(self.key_strings)
+
+    # unlike dict views, these are single use iterators. They avoid looking
+    # each key up again.
+    def items(self):
+        return zip(self.key_strings, map(self._value, range(len(self))))
+
+    def values(self):
+        return map(self._value, range(len(self)))
+
+MAPPED_ROW_TYPES = {'RouteInfo': RouteInfo, 'Trip': Trip, 'StopInfo': StopInfo, 'str': str, 'list': list}
 
 def get_stop_lines_dict(gtfs_tup, include_dropoff_only=False):
     '''
-    Build and return a dict mapping stops to the routes that stop at them.
+    Return a dict mapping stop codes to a sorted list of the route numbers that
+    stop at them.
         - set include_dropoff_only to include stops tagged as "dropoff only" in
           the gtfs. Useful for mapping possible tap locations in a system
           without exit taps
+        - the dict comes from the index built when the feed was loaded (see
+          build_stop_lines_index), and is shared: do not modify it
     '''
-    trips  = gtfs_tup.trips
-    routes = gtfs_tup.routes
-    stops  = gtfs_tup.stops
+    stop_lines = gtfs_tup.stop_lines or build_stop_lines_index(gtfs_tup)
+    return stop_lines[include_dropoff_only]
+
+def build_stop_lines_index(gtfs_tup) -> dict[bool, dict[str, list[str]]]:
+    '''
+    Build the stop lines dicts for both values of include_dropoff_only (see
+    get_stop_lines_dict) in a single pass over the stop_times columns
+    '''
+    stoptimes  = gtfs_tup.stoptimes
+    trip_route = stoptimes.trip_route
+
+    # (stop idx, route idx) pairs, with and without dropoff only stop times
+    pickup_pairs, all_pairs = set(), set()
+
+    for stop, trip, pickup, dropoff in zip(stoptimes.stop, stoptimes.trip,
+                                           stoptimes.pickup_type, stoptimes.dropoff_type):
+        pair = (stop, trip_route[trip])
+        all_pairs.add(pair)
+        if not (pickup == 1 and dropoff != 1):
+            pickup_pairs.add(pair)
 
     results = {}
+    for include_dropoff_only, pairs in ((False, pickup_pairs), (True, all_pairs)):
+        lines = {}
+        for stop, route in pairs:
+            # stop times of trips missing from trips.txt
+            if route < 0:
+                continue
+            stop_code = gtfs_tup.stops[stoptimes.stop_ids[stop]].code
+            rt = gtfs_tup.routes[stoptimes.route_ids[route]].num
+
+            if stop_code not in lines:
+                lines[stop_code] = set()
+            lines[stop_code].add(rt)
+
+        results[include_dropoff_only] = {stop_code: sorted(lines[stop_code]) for stop_code in lines}
 
-    for stop_time in gtfs_tup.stoptimes:
-        t_id, _, _, stop_id, _, _, _, _ = stop_time 
-        stop_code = stops[stop_id].code
-        trip = trips[t_id]
-        rt_id = trip.rt_id
-        rt = routes[rt_id].num
-
-        if include_dropoff_only or not is_dropoff_only(stop_time):
-            if stop_code not in results:
-                results[stop_code] = set()
-            results[stop_code].add(rt)
-        
-    results = {stop_code: sorted(results[stop_code]) for stop_code in results}
     return results
 
-def get_routes_dict(fp) -> dict[str, RouteInfo]:
+def get_departures(gtfs_tup) -> 'Departures':
+    '''
+    Return the departures index of the given GTFS tuple (see Departures),
+    built when the feed was loaded
+    '''
+    return gtfs_tup.departures or build_departures_index(gtfs_tup)
+
+def build_departures_index(gtfs_tup) -> 'Departures':
+    '''
+    Build the departures index (see Departures) in a single pass over the
+    stop_times columns, grouping stop times by the code of their stop, then
+    sorting each stop's departures by time
+    '''
+    stoptimes = gtfs_tup.stoptimes
+    stops = gtfs_tup.stops
+
+    # code index of each stop index (-1 for stops without a code)
+    codes_of = [stops[s_id].code if s_id in stops else '' for s_id in stoptimes.stop_ids]
+    stop_codes = sorted(set([code for code in codes_of if code]))
+    code_idx = {code: idx for idx, code in enumerate(stop_codes)}
+    stop_code = [code_idx.get(code, -1) for code in codes_of]
+
+    by_code = [[] for _ in stop_codes]
+    for row, (stop, dep_time, pickup) in enumerate(zip(stoptimes.stop, stoptimes.dep_time,
+                                                       stoptimes.pickup_type)):
+        # passengers can not board at untimed or dropoff only stop times
+        if dep_time < 0 or pickup == 1:
+            continue
+        code = stop_code[stop]
+        if code >= 0:
+            by_code[code].append(row)
+
+    dep_time = stoptimes.dep_time
+    start, times, rows = array('I', [0]), array('i'), array('I')
+    for code_rows in by_code:
+        code_rows.sort(key=dep_time.__getitem__)
+        rows.extend(code_rows)
+        times.extend(map(dep_time.__getitem__, code_rows))
+        start.append(len(rows))
+
+    return Departures(stop_codes, stoptimes, start, times, rows)
+
+class Departures:
+    '''
+    Index of the departures from each stop code, sorted by time, to look up
+    the trips leaving a stop around a given time without scanning stop_times
+        - stop_codes is sorted, and the departures from stop_codes[idx] are
+          times[start[idx]:start[idx + 1]] (seconds since midnight of the
+          service day), with rows holding the StopTimes row of each
+        - only stop times passengers can board at are included: those with a
+          departure time that are not dropoff only
+    Columns may be arrays, or memoryviews of a mapped snapshot.
+    '''
+    COLUMNS = {'start': 'I', 'times': 'i', 'rows': 'I'}
+
+    def __init__(self, stop_codes, stoptimes, start, times, rows):
+        self.stop_codes = stop_codes
+        self.stoptimes  = stoptimes
+        self.start      = start
+        self.times      = times
+        self.rows       = rows
+        self._code_idx  = {}
+
+    def code_index(self, stop_code) -> int:
+        '''
+        Return the index of stop_code in stop_codes, or -1 if no trips board
+        there
+        '''
+        idx = self._code_idx.get(stop_code)
+        if idx is None:
+            idx = bisect_left(self.stop_codes, stop_code)
+            if idx == len(self.stop_codes) or self.stop_codes[idx] != stop_code:
+                idx = -1
+            self._code_idx[stop_code] = idx
+        return idx
+
+    def between(self, stop_code, start_secs, end_secs) -> list[int]:
+        '''
+        Return the StopTimes rows of the departures from stop_code from
+        start_secs to end_secs (inclusive), in order of departure
+        '''
+        idx = self.code_index(stop_code)
+        if idx < 0:
+            return []
+        lo, hi = self.start[idx], self.start[idx + 1]
+        first = bisect_left(self.times, start_secs, lo, hi)
+        last = bisect_right(self.times, end_secs, first, hi)
+        return list(self.rows[first:last])
+
+    def nearest(self, stop_code, secs, window, date=None, calendar=None) -> int:
+        '''
+        Return the StopTimes row of the departure from stop_code closest to
+        secs (seconds since midnight), if it is at most window seconds away,
+        otherwise -1
+            - trips running after midnight are listed under the previous
+              service day, with times past 24:00:00, so they are matched
+              against secs + 24h as well
+            - if date and a ServiceCalendar are given, only trips running on
+              that date (or the day before, for times past 24:00:00) match
+        '''
+        best_row, best_diff = -1, window + 1
+        for days_back, day_secs in ((0, secs), (1, secs + 86400)):
+            day_type = calendar.day_type(date - datetime.timedelta(days=days_back)) if calendar and date else -1
+            for row in self.between(stop_code, day_secs - window, day_secs + window):
+                diff = abs(self.stoptimes.dep_time[row] - day_secs)
+                if diff < best_diff and (day_type < 0 or calendar.runs(self.stoptimes.trip[row], day_type)):
+                    best_row, best_diff = row, diff
+        return best_row
+
+    def route_id(self, row) -> str:
+        '''
+        Return the route id of the trip of the given StopTimes row, or None
+        if the trip is missing from trips.txt
+        '''
+        route = self.stoptimes.trip_route[self.stoptimes.trip[row]]
+        return self.stoptimes.route_ids[route] if route >= 0 else None
+
+def get_stop_lines_on(gtfs_tup, stop_code, dates) -> list[str]:
+    '''
+    Return a sorted list of the route numbers that pick up at stop_code on
+    any of the given dates, according to the feed's service calendar (see
+    ServiceCalendar.routes)
+        - falls back to every route stopping there (see get_stop_lines_dict)
+          if the feed has no calendar, or no dates are given
+    '''
+    calendar = gtfs_tup.calendar
+    if not calendar or not dates:
+        return get_stop_lines_dict(gtfs_tup).get(stop_code, [])
+    route_ids = calendar.routes(stop_code, dates)
+    return sorted(set([gtfs_tup.routes[rt_id].num for rt_id in route_ids if rt_id in gtfs_tup.routes]))
+
+def read_gtfs_calendar(gtfs_dir) -> (dict, list):
+    '''
+    Read the calendar.txt and calendar_dates.txt files in gtfs_dir (either may
+    be missing), returning the results of get_calendar_dict and
+    get_calendar_dates (empty if the file is missing)
+    '''
+    calendar, calendar_dates = {}, []
+    if os.path.exists(os.path.join(gtfs_dir, 'calendar.txt')):
+        calendar = _parse_gtfs_file(gtfs_dir, 'calendar.txt', get_calendar_dict)
+    if os.path.exists(os.path.join(gtfs_dir, 'calendar_dates.txt')):
+        calendar_dates = _parse_gtfs_file(gtfs_dir, 'calendar_dates.txt', get_calendar_dates)
+    return calendar, calendar_dates
+
+def get_calendar_dict(fp) -> dict[str, tuple]:
+    '''
+    Read the GTFS calendar.txt file pointed to by fp, and return a dict d:
+        d[service_id]: (weekdays, start, end), where weekdays is a tuple of
+                       7 bools (Monday first), and start/end are the date
+                       ordinals of the first and last day of service
+    '''
+    results = {}
+    rows = read_csv_rows(fp, ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                              'saturday', 'sunday', 'start_date', 'end_date'),
+                         required=('service_id', 'start_date', 'end_date'))
+
+    for s_id, *weekdays, start, end in rows:
+        results[s_id] = (tuple([day.strip() == '1' for day in weekdays]),
+                         parse_gtfs_date(start), parse_gtfs_date(end))
+
+    return results
+
+def get_calendar_dates(fp) -> list[tuple]:
+    '''
+    Read the GTFS calendar_dates.txt file pointed to by fp, returning a list of
+    (service_id, date ordinal, added) tuples, where added is False for dates
+    the service is removed from
+    '''
+    rows = read_csv_rows(fp, ('service_id', 'date', 'exception_type'),
+                         required=('service_id', 'date', 'exception_type'))
+    return [(s_id, parse_gtfs_date(date), exception.strip() == '1') for s_id, date, exception in rows]
+
+def parse_gtfs_date(date_str) -> int:
+    '''
+    Convert a GTFS YYYYMMDD date to a date ordinal (see date.toordinal)
+    '''
+    date_str = date_str.strip()
+    return datetime.date(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:8])).toordinal()
+
+def build_service_calendar(gtfs_tup, calendar, calendar_dates) -> 'ServiceCalendar':
+    '''
+    Build the ServiceCalendar of a feed from the results of read_gtfs_calendar,
+    or return None if the feed has no calendar
+        - each day of the feed is given a day type, one per distinct set of
+          services running, so that the per stop route sets only need to be
+          computed once per day type rather than per date
+    '''
+    if not calendar and not calendar_dates:
+        return None
+
+    stoptimes  = gtfs_tup.stoptimes
+    departures = get_departures(gtfs_tup)
+    trips      = gtfs_tup.trips
+
+    service_ids = sorted(set(calendar) | set([s_id for s_id, _, _ in calendar_dates]))
+    service_idx = {s_id: idx for idx, s_id in enumerate(service_ids)}
+    trip_service = array('i', [service_idx.get(trips[t_id].service_id, -1) if t_id in trips else -1
+                               for t_id in stoptimes.trip_ids])
+
+    # services running on each day of the feed, as bitsets
+    dates = [start for _, start, _ in calendar.values()] + [end for _, _, end in calendar.values()] + \
+            [date for _, date, _ in calendar_dates]
+    start, end = min(dates), max(dates)
+    day_services = [0] * (end - start + 1)
+    for s_id, (weekdays, s_start, s_end) in calendar.items():
+        bit = 1 << service_idx[s_id]
+        for date in range(s_start, s_end + 1):
+            # ordinal 1 (0001-01-01) was a Monday
+            if weekdays[(date - 1) % 7]:
+                day_services[date - start] |= bit
+    for s_id, date, added in calendar_dates:
+        bit = 1 << service_idx[s_id]
+        if added:
+            day_services[date - start] |= bit
+        else:
+            day_services[date - start] &= ~bit
+
+    type_idx, type_bits = {}, []
+    day_types = array('I')
+    for services in day_services:
+        if services not in type_idx:
+            type_idx[services] = len(type_bits)
+            type_bits.append(services)
+        day_types.append(type_idx[services])
+
+    # the (stop code, service, route) triples of every stop time passengers
+    # can board at, packed into single ints
+    num_services, num_routes = len(service_ids), len(stoptimes.route_ids)
+    code_of = [departures.code_index(gtfs_tup.stops[s_id].code) if s_id in gtfs_tup.stops else -1
+               for s_id in stoptimes.stop_ids]
+    trip_route = stoptimes.trip_route
+    triples = set()
+    for stop, trip, pickup, dropoff in zip(stoptimes.stop, stoptimes.trip,
+                                           stoptimes.pickup_type, stoptimes.dropoff_type):
+        if pickup == 1 and dropoff != 1:
+            continue
+        code, service, route = code_of[stop], trip_service[trip], trip_route[trip]
+        if code >= 0 and service >= 0 and route >= 0:
+            triples.add((code*num_services + service)*num_routes + route)
+
+    # routes of each service at each stop code, as bitsets
+    stop_services = [{} for _ in departures.stop_codes]
+    for triple in triples:
+        code_service, route = divmod(triple, num_routes)
+        code, service = divmod(code_service, num_services)
+        stop_services[code][service] = stop_services[code].get(service, 0) | (1 << route)
+
+    # routes of each day type at each stop code, as indices into a pool of
+    # distinct route sets
+    route_width = (num_routes + 7) // 8
+    set_idx, route_sets = {0: 0}, bytearray(route_width)
+    stop_types = array('I')
+    for services in stop_services:
+        for type_services in type_bits:
+            routes = 0
+            for service, service_routes in services.items():
+                if type_services >> service & 1:
+                    routes |= service_routes
+            if routes not in set_idx:
+                set_idx[routes] = len(set_idx)
+                route_sets += routes.to_bytes(route_width, 'little')
+            stop_types.append(set_idx[routes])
+
+    service_width = (num_services + 7) // 8
+    type_services = b''.join([services.to_bytes(service_width, 'little') for services in type_bits])
+
+    return ServiceCalendar(service_ids, departures, trip_service, day_types, type_services,
+                           stop_types, route_sets, start, service_width, route_width)
+
+class ServiceCalendar:
+    '''
+    Which services run on each day of a feed, and the routes picking up at
+    each stop on each day, from calendar.txt and calendar_dates.txt
+        - days are grouped into day types, one per distinct set of running
+          services: day_types[date - start] is the day type of a date, and
+          type_services holds the services of each day type as a bitset
+          (service_width bytes each) over service_ids
+        - trip_service maps a StopTimes trip index to an index into
+          service_ids (-1 if unknown)
+        - the routes of each (stop code, day type) are a bitset over
+          stoptimes.route_ids (route_width bytes each) in route_sets, at the
+          index stop_types[code*len(day types) + day type], where code is the
+          index of the stop code in the departures index
+    Answering which routes serve a stop on a set of dates takes one bitwise
+    OR per distinct day type among the dates, rather than a scan of
+    stop_times. Columns may be arrays, or memoryviews of a mapped snapshot.
+    '''
+    COLUMNS = {'trip_service': 'i', 'day_types': 'I', 'type_services': '',
+               'stop_types': 'I', 'route_sets': ''}
+
+    def __init__(self, service_ids, departures, trip_service, day_types, type_services,
+                 stop_types, route_sets, start, service_width, route_width):
+        self.service_ids   = service_ids
+        self.departures    = departures
+        self.trip_service  = trip_service
+        self.day_types     = day_types
+        self.type_services = type_services
+        self.stop_types    = stop_types
+        self.route_sets    = route_sets
+        self.start         = start
+        self.service_width = service_width
+        self.route_width   = route_width
+        self.num_types     = len(type_services) // service_width if service_width else 1
+        self._services     = {}
+
+    def day_type(self, date) -> int:
+        '''
+        Return the day type of the given date (a date or datetime)
+            - dates outside of the feed's calendar are given the day type of
+              the nearest date in it that falls on the same weekday, i.e. the
+              service of a regular week at the start or end of the feed
+        '''
+        num_days = len(self.day_types)
+        day = date.toordinal() - self.start
+        if day < 0:
+            day %= 7
+        elif day >= num_days:
+            day = num_days - 1 - (num_days - 1 - day) % 7
+        return self.day_types[min(max(day, 0), num_days - 1)]
+
+    def services(self, day_type) -> int:
+        '''
+        Return the services running on the given day type, as a bitset over
+        service_ids
+        '''
+        services = self._services.get(day_type)
+        if services is None:
+            width = self.service_width
+            services = self._services[day_type] = int.from_bytes(
+                self.type_services[day_type*width:(day_type + 1)*width], 'little')
+        return services
+
+    def runs(self, trip, day_type) -> bool:
+        '''
+        Return whether the trip with the given StopTimes trip index runs on
+        the given day type (trips with an unknown service always do)
+        '''
+        service = self.trip_service[trip]
+        return service < 0 or bool(self.services(day_type) >> service & 1)
+
+    def routes(self, stop_code, dates) -> list[str]:
+        '''
+        Return the ids of the routes picking up at stop_code on any of the
+        given dates (dates or datetimes)
+        '''
+        code = self.departures.code_index(stop_code)
+        if code < 0:
+            return []
+
+        routes, width = 0, self.route_width
+        for day_type in set([self.day_type(date) for date in dates]):
+            set_idx = self.stop_types[code*self.num_types + day_type]
+            routes |= int.from_bytes(self.route_sets[set_idx*width:(set_idx + 1)*width], 'little')
+
+        route_ids = self.departures.stoptimes.route_ids
+        return [route_ids[route] for route in range(routes.bit_length()) if routes >> route & 1]
+
+def get_routes_dict(fp, strings=None) -> dict[str, RouteInfo]:
     '''
     Read the GTFS routes.txt file point to by fp, and return a dict d:
         d[rt_id]: RouteInfo tuple
+    Values are interned in strings (a PooledStrings), if given.
     '''
     results = {}
+    rows = read_csv_rows(fp, ('route_id', 'route_short_name', 'route_long_name', 'route_type',
+                              'route_color', 'route_text_color'), required=('route_id',))
 
-    for line in grab_csv_lines(fp)[1:]:
-        rt_id, _, rt_num, rt_name, _, rt_type, _, rt_color, rt_txt_colour = line.split(',')
-
-        results[rt_id] = RouteInfo(rt_num, rt_name, rt_type, rt_color, rt_txt_colour)
+    intern = (strings if strings is not None else PooledStrings()).intern
+    for rt_id, rt_num, rt_name, rt_type, rt_color, rt_txt_colour in rows:
+        results[rt_id] = RouteInfo(intern(rt_num), intern(rt_name), intern(rt_type), intern(rt_color),
+                                   intern(rt_txt_colour))
 
     return results
 
-def get_trips_dict(fp) -> dict[str, Trip]:
+def get_trips_dict(fp, strings=None) -> dict[str, Trip]:
     '''
     Read the GTFS trips.text file pointed to by fp, and return a dict d:
         d[trip_id]: Trip tuple
+    Values are interned in strings (a PooledStrings), if given.
     '''
     results = {}
+    # headsign is not used by all agencies and should just use the headsign
+    # on the stop times instead
+    rows = read_csv_rows(fp, ('route_id', 'service_id', 'trip_id', 'direction_id', 'block_id',
+                              'shape_id', 'wheelchair_accessible', 'bikes_allowed'),
+                         required=('route_id', 'trip_id'))
 
-    for line in grab_csv_lines(fp)[1:]:
-        # headsign is not used by all agencies and should just use the headsign
-        # on the stop times instead
-        rt_id, s_id, t_id, t_headsign, _, direction, block_id, shape_id, wheelchair, bike = line.split(',')
-
-        results[t_id] = Trip(rt_id, s_id, block_id, shape_id, direction, wheelchair, bike)
+    # every field but the trip id is shared by many trips
+    intern = (strings if strings is not None else PooledStrings()).intern
+    for rt_id, s_id, t_id, direction, block_id, shape_id, wheelchair, bike in rows:
+        results[t_id] = Trip(intern(rt_id), intern(s_id), intern(block_id), intern(shape_id), intern(direction),
+                             intern(wheelchair), intern(bike))
 
     return results
 
 
-def read_gtfs_stops(fp) -> (dict[str, StopInfo], dict[str, str]):
+def read_gtfs_stops(fp, strings=None) -> (dict[str, StopInfo], dict[str, str]):
     '''
     Read a GTFS stops.txt file, returning two dicts as follows:
         - stop_id: StopInfo
         - stop_code: stop_name
+    Stop names are interned in strings (a PooledStrings), if given.
     '''
     stops, code_to_name = {}, {}
 
-    # skip file header when receiving the list of lines
-    for line in grab_csv_lines(fp)[1:]:
-        contents = line.split(',')
-        sid = contents[0]
-        scode = contents[1]
-        sname = contents[2]
-        
+    intern = (strings if strings is not None else PooledStrings()).intern
+    for sid, scode, sname in read_csv_rows(fp, ('stop_id', 'stop_code', 'stop_name'),
+                                           required=('stop_id',)):
+        sname = intern(sname)
         stops[sid] = StopInfo(scode, sname)
         code_to_name[scode] = sname
 
     return stops, code_to_name
 
-def get_stoptimes(fp) -> list[StopTime]:
+def get_stoptimes(fp) -> 'StopTimes':
     '''
-    Read a GTFS stop_times.txt file, returning a list of StopTime tuples
+    Read a GTFS stop_times.txt file, returning a StopTimes store of its rows
     '''
-    results = []
-    
-    # skip file header
-    fp.readline()
+    results = StopTimes()
+    times = {'': -1}
+    rows = read_csv_rows(fp, ('trip_id', 'arrival_time', 'departure_time', 'stop_id',
+                              'stop_sequence', 'pickup_type', 'drop_off_type',
+                              'shape_dist_traveled'), required=('trip_id', 'stop_id'))
+
+    for t_id, arr_time, dep_time, stop_id, stop_seq, pickup, dropoff, dist in rows:
 
-    for line in fp:
-        line = line.strip()
-        t_id, arr_time, dep_time, stop_id, stop_seq, _, pickup, dropoff, dist = line.split(',')
-        
-        results.append( StopTime(t_id, arr_time, dep_time, stop_id, stop_seq, pickup, dropoff, dist) )
+        # there are far fewer distinct times than rows, so only parse each once
+        arr_secs = times.get(arr_time)
+        if arr_secs is None:
+            arr_secs = times[arr_time] = parse_gtfs_time(arr_time)
+        dep_secs = times.get(dep_time)
+        if dep_secs is None:
+            dep_secs = times[dep_time] = parse_gtfs_time(dep_time)
+
+        results.append(t_id, arr_secs, dep_secs, stop_id, int(stop_seq),
+                       int(pickup or 0), int(dropoff or 0), float(dist) if dist else NAN)
 
     return results
 
-    
+def parse_gtfs_time(time_str) -> int:
+    '''
+    Convert a GTFS HH:MM:SS time to seconds since midnight of the service day
+    (which may be past 24:00:00 for trips running after midnight), or -1 if
+    the time is blank
+    '''
+    if not time_str.strip():
+        return -1
+    hr, mins, secs = time_str.split(':')
+    return int(hr)*3600 + int(mins)*60 + int(secs)
+
+def format_gtfs_time(secs) -> str:
+    '''
+    Inverse of parse_gtfs_time
+    '''
+    if secs < 0:
+        return ''
+    return '%02d:%02d:%02d' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+class StopTimes:
+    '''
+    Columnar store of the rows of a GTFS stop_times.txt file
+        - trip, stop and route ids are interned: the trip and stop columns
+          hold indices into trip_ids/stop_ids, and trip_route maps a trip
+          index to an index into route_ids (see link_trips)
+        - arrival/departure times are stored as seconds since midnight (-1
+          if blank), pickup/dropoff types as uint8 and distances as float32
+          (NaN if blank)
+        - iterating over the store (or indexing it) yields StopTime tuples
+          of the decoded values, so it can be used in place of a list of
+          StopTimes
+    Columns may be arrays, or memoryviews of a mapped snapshot, in which case
+    the store is read-only.
+    '''
+    COLUMNS = {'trip': 'i', 'arr_time': 'i', 'dep_time': 'i', 'stop': 'i',
+               'stop_seq': 'i', 'pickup_type': 'B', 'dropoff_type': 'B',
+               'dist': 'f', 'trip_route': 'i'}
+
+    def __init__(self, trip_ids=None, stop_ids=None, route_ids=None, columns=None):
+        self.trip_ids  = trip_ids if trip_ids is not None else []
+        self.stop_ids  = stop_ids if stop_ids is not None else []
+        self.route_ids = route_ids if route_ids is not None else []
+        # only needed to add rows, which mapped stores do not support
+        if columns is None:
+            self._trip_idx = {t_id: idx for idx, t_id in enumerate(self.trip_ids)}
+            self._stop_idx = {s_id: idx for idx, s_id in enumerate(self.stop_ids)}
+
+        columns = columns or {}
+        for name, typecode in self.COLUMNS.items():
+            setattr(self, name, columns[name] if name in columns else array(typecode))
+
+    def append(self, trip_id, arr_time, dep_time, stop_id, stop_seq, pickup_type,
+               dropoff_type, dist):
+        '''
+        Add a row, with times in seconds since midnight
+        '''
+        trip_idx = self._trip_idx.get(trip_id)
+        if trip_idx is None:
+            trip_idx = self._intern(trip_id, self.trip_ids, self._trip_idx)
+        stop_idx = self._stop_idx.get(stop_id)
+        if stop_idx is None:
+            stop_idx = self._intern(stop_id, self.stop_ids, self._stop_idx)
+
+        self.trip.append(trip_idx)
+        self.arr_time.append(arr_time)
+        self.dep_time.append(dep_time)
+        self.stop.append(stop_idx)
+        self.stop_seq.append(stop_seq)
+        self.pickup_type.append(pickup_type)
+        self.dropoff_type.append(dropoff_type)
+        self.dist.append(dist)
+
+    def extend(self, other):
+        '''
+        Append the rows of another StopTimes store, re-interning its ids
+        '''
+        trip_remap = array('i', [self._intern(t_id, self.trip_ids, self._trip_idx)
+                                 for t_id in other.trip_ids])
+        stop_remap = array('i', [self._intern(s_id, self.stop_ids, self._stop_idx)
+                                 for s_id in other.stop_ids])
+
+        self.trip.extend(array('i', map(trip_remap.__getitem__, other.trip)))
+        self.stop.extend(array('i', map(stop_remap.__getitem__, other.stop)))
+        for name in ('arr_time', 'dep_time', 'stop_seq', 'pickup_type', 'dropoff_type', 'dist'):
+            getattr(self, name).extend(getattr(other, name))
+
+    @staticmethod
+    def _intern(value, values, value_idx):
+        idx = value_idx.get(value)
+        if idx is None:
+            idx = value_idx[value] = len(values)
+            values.append(value)
+        return idx
+
+    def link_trips(self, trips):
+        '''
+        Fill in trip_route/route_ids from the given trips dict (see
+        get_trips_dict). Trips missing from the dict map to route index -1.
+        '''
+        route_idx = {}
+        self.route_ids = []
+        self.trip_route = array('i')
+
+        for t_id in self.trip_ids:
+            trip = trips.get(t_id)
+            if trip is None:
+                self.trip_route.append(-1)
+                continue
+            if trip.rt_id not in route_idx:
+                route_idx[trip.rt_id] = len(self.route_ids)
+                self.route_ids.append(trip.rt_id)
+            self.trip_route.append(route_idx[trip.rt_id])
+
+    def columns(self) -> dict:
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    def nbytes(self) -> int:
+        '''
+        Return the size of the columns, in bytes
+        '''
+        return sum(col.itemsize * len(col) for col in self.columns().values())
+
+    def __len__(self):
+        return len(self.trip)
+
+    def __getitem__(self, idx):
+        return self._row(self.trip[idx], self.arr_time[idx], self.dep_time[idx], self.stop[idx],
+                         self.stop_seq[idx], self.pickup_type[idx], self.dropoff_type[idx],
+                         self.dist[idx])
+
+    def __iter__(self):
+        row = self._row
+        for cols in zip(self.trip, self.arr_time, self.dep_time, self.stop, self.stop_seq,
+                        self.pickup_type, self.dropoff_type, self.dist):
+            yield row(*cols)
+
+    def _row(self, trip, arr_time, dep_time, stop, stop_seq, pickup_type, dropoff_type, dist):
+        return StopTime(self.trip_ids[trip], arr_time if arr_time >= 0 else None,
+                        dep_time if dep_time >= 0 else None, self.stop_ids[stop], stop_seq,
+                        pickup_type, dropoff_type, dist if dist == dist else None)
+
 def is_dropoff_only(stoptime_tuple):
     '''
     Returns True if the stop tim specified by the given stoptime_tuple is
     dropoff only, else False
     '''
-    return stoptime_tuple.pickup_type == '1' and stoptime_tuple.dropoff_type != '1'
+    return stoptime_tuple.pickup_type == 1 and stoptime_tuple.dropoff_type != 1
+
+if __name__ == '__main__':
+    # compile a snapshot ahead of time: python3 gtfs.py gtfs_dir [snapshot_path]
+    if len(sys.argv) < 2:
+        print("usage: %s gtfs_dir [snapshot_path]" % (sys.argv[0]))
+        sys.exit(1)
+    compile_gtfs(*sys.argv[1:3])
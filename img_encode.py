@@ -0,0 +1,61 @@
+import io, os
+from PIL import Image, ImageChops
+import metrics
+
+# output formats and the extension of their files. Lossless webp is several
+# times smaller than png for our charts, but takes a little longer to encode.
+FORMATS = {'png': '.png', 'webp': '.webp'}
+IMG_FORMAT = os.environ.get('RETRACEIT_IMG_FORMAT', 'png')
+# png: zlib level, 0 (fastest) to 9 (smallest); webp: encoder method, 0
+# (fastest) to 6 (smallest)
+PNG_COMPRESS_LEVEL = int(os.environ.get('RETRACEIT_PNG_COMPRESS_LEVEL', 6))
+WEBP_METHOD        = int(os.environ.get('RETRACEIT_WEBP_METHOD', 4))
+
+def filename(name: str, fmt: str = IMG_FORMAT) -> str:
+    '''
+    Return the file name of an image called name encoded as fmt
+    '''
+    return name + FORMATS[fmt]
+
+def flatten(img: Image, palette=True) -> Image:
+    '''
+    Return img in the smallest mode that represents it exactly: without its
+    alpha channel if it is fully opaque, and (if palette is set) as a palette
+    image if it has at most 256 colours
+    '''
+    if img.mode == 'RGBA' and img.getchannel('A').getextrema() == (255, 255):
+        img = img.convert('RGB')
+    colors = img.getcolors(256) if palette and img.mode == 'RGB' else None
+    if colors is None:
+        return img
+
+    # median cut with one box per colour gives an exact palette, but this is
+    # checked rather than assumed
+    palette_img = img.quantize(colors=len(colors), method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    if ImageChops.difference(palette_img.convert('RGB'), img).getbbox() is not None:
+        return img
+    return palette_img
+
+def encode(img: Image, fmt: str = IMG_FORMAT, compress_level=None) -> bytes:
+    '''
+    Encode img as fmt (see FORMATS), losslessly, and return the encoded bytes
+        - compress_level overrides PNG_COMPRESS_LEVEL or WEBP_METHOD
+        - the time taken is recorded as the encode_<fmt> stage, and the size
+          in the retraceit_encoded_bytes histogram
+    '''
+    if fmt not in FORMATS:
+        raise ValueError("unknown image format %s (formats: %s)" % (fmt, ', '.join(FORMATS)))
+
+    fp = io.BytesIO()
+    with metrics.span('encode_' + fmt):
+        if fmt == 'png':
+            flatten(img).save(fp, format='png',
+                              compress_level=PNG_COMPRESS_LEVEL if compress_level is None else compress_level)
+        else:
+            # lossless webp makes its own palette when it can
+            flatten(img, palette=False).save(fp, format='webp', lossless=True,
+                                             method=WEBP_METHOD if compress_level is None else compress_level)
+
+    data = fp.getvalue()
+    metrics.REGISTRY.observe('retraceit_encoded_bytes', len(data), buckets=metrics.SIZE_BUCKETS, format=fmt)
+    return data
@@ -0,0 +1,311 @@
+import os, sys, time, threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; spans do not report memory there
+    resource = None
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# upper bounds (in bytes) of the encoded image size histogram buckets
+SIZE_BUCKETS    = (16 << 10, 32 << 10, 64 << 10, 128 << 10, 256 << 10, 512 << 10, 1 << 20, 2 << 20, 4 << 20, 8 << 20)
+# number of recent observations kept per stage/command for percentiles
+RECENT_SAMPLES  = 1000
+
+# prometheus text export: to a file, rewritten every METRICS_INTERVAL
+# seconds, and/or over http at /metrics on METRICS_PORT
+METRICS_FILE     = os.environ.get('RETRACEIT_METRICS_FILE')
+METRICS_PORT     = int(os.environ.get('RETRACEIT_METRICS_PORT', 0))
+METRICS_HOST     = os.environ.get('RETRACEIT_METRICS_HOST', '127.0.0.1')
+METRICS_INTERVAL = float(os.environ.get('RETRACEIT_METRICS_INTERVAL', 15))
+
+# sampling profiler for slow requests (off unless PROFILE_SLOW_MS is set):
+# requests slower than this have their sampled stacks written to PROFILE_DIR
+PROFILE_SLOW_MS     = float(os.environ.get('RETRACEIT_PROFILE_SLOW_MS', 0))
+PROFILE_DIR         = os.environ.get('RETRACEIT_PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL_MS = float(os.environ.get('RETRACEIT_PROFILE_INTERVAL_MS', 5))
+
+HELP = {
+    'retraceit_stage_seconds':                 'Time spent in each processing stage',
+    'retraceit_stage_rss_growth_bytes_total':  'How much each stage raised the peak RSS of the process',
+    'retraceit_command_seconds':               'Time taken to answer each command, including time queued',
+    'retraceit_commands_total':                'Commands answered, by result',
+    'retraceit_encoded_bytes':                 'Size of each encoded image, by format',
+    'retraceit_gtfs_footprint_bytes':          'Memory held by each loaded GTFS feed (0 once unloaded)',
+    'retraceit_gtfs_unloads_total':            'GTFS feeds unloaded to stay within the memory budget',
+    'retraceit_gtfs_reload_peak_rss_bytes':    'Peak RSS while the old and new copies of a reloaded GTFS feed were both loaded',
+}
+
+class histogram:
+    '''
+    Prometheus-style latency histogram, plus a window of the most recent
+    observations for percentiles
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * len(buckets)
+        self.count   = 0
+        self.sum     = 0.0
+        self.recent  = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, pct):
+        '''
+        Return the pct-th percentile of the recent observations (nearest rank),
+        or None if there are none
+        '''
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+class registry:
+    '''
+    Thread-safe collection of histograms, counters and gauges, keyed by
+    metric name and a tuple of (label, value) pairs
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.counters   = {}
+        self.gauges     = {}
+        self._lock      = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def percentiles(self, name, pcts=(50, 99)) -> dict:
+        '''
+        Return {labels: (count, [percentiles])} for every histogram called name
+        '''
+        with self._lock:
+            return {labels: (hist.count, [hist.percentile(pct) for pct in pcts])
+                    for (hist_name, labels), hist in self.histograms.items() if hist_name == name}
+
+    def prometheus_text(self) -> str:
+        '''
+        Return all metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            for name in sorted(set([name for name, _ in self.histograms])):
+                lines += ['# HELP %s %s' % (name, HELP.get(name, name)), '# TYPE %s histogram' % (name)]
+                for (hist_name, labels), hist in sorted(self.histograms.items()):
+                    if hist_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (name, _labels_text(labels + (('le', repr(float(bound))),)), cumulative))
+                    lines.append('%s_bucket%s %d' % (name, _labels_text(labels + (('le', '+Inf'),)), hist.count))
+                    lines.append('%s_sum%s %r' % (name, _labels_text(labels), hist.sum))
+                    lines.append('%s_count%s %d' % (name, _labels_text(labels), hist.count))
+
+            for metric_type, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set([name for name, _ in values])):
+                    lines += ['# HELP %s %s' % (name, HELP.get(name, name)), '# TYPE %s %s' % (name, metric_type)]
+                    for (value_name, labels), value in sorted(values.items()):
+                        if value_name == name:
+                            lines.append('%s%s %r' % (name, _labels_text(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    escaped = [(label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for label, value in labels]
+    return '{%s}' % (','.join(['%s="%s"' % (label, value) for label, value in escaped]))
+
+REGISTRY = registry()
+
+def peak_rss() -> int:
+    '''
+    Return the peak RSS of this process so far, in bytes (0 if unknown)
+    '''
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def current_rss() -> int:
+    '''
+    Return the current RSS of this process, in bytes (the peak RSS where the
+    current one is not available)
+    '''
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+class rss_sampler:
+    '''
+    Tracks the highest RSS of this process from start() until stop(), by
+    sampling it every interval seconds from a background thread
+    '''
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak     = 0
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def start(self):
+        self.peak = current_rss()
+        self._thread.start()
+
+    def stop(self) -> int:
+        '''
+        Stop sampling, and return the peak RSS seen, in bytes
+        '''
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+@contextmanager
+def span(stage, profile=False):
+    '''
+    Time the code in the with block as stage, recording its duration and how
+    much it raised the peak RSS of the process
+        - if profile is set and slow request profiling is enabled, the
+          running thread is sampled while in the block, and the samples are
+          written to PROFILE_DIR if it took longer than PROFILE_SLOW_MS
+    '''
+    profiler = sampling_profiler(threading.get_ident()) if profile and PROFILE_SLOW_MS else None
+    if profiler:
+        profiler.start()
+
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        REGISTRY.observe('retraceit_stage_seconds', elapsed, stage=stage)
+        REGISTRY.inc('retraceit_stage_rss_growth_bytes_total', peak_rss() - rss_before, stage=stage)
+
+        if profiler:
+            profiler.stop()
+            if elapsed * 1000 >= PROFILE_SLOW_MS:
+                path = profiler.write(stage)
+                print("%s took %.2fs, wrote profile: %s" % (stage, elapsed, path))
+
+def record_command(command, elapsed, status='ok'):
+    '''
+    Record the end to end latency and result (e.g. ok, cached, busy,
+    timeout) of a command
+    '''
+    REGISTRY.observe('retraceit_command_seconds', elapsed, command=command)
+    REGISTRY.inc('retraceit_commands_total', command=command, status=status)
+
+class sampling_profiler:
+    '''
+    Samples the stack of a thread every interval_ms milliseconds from a
+    background thread, counting identical stacks
+        - write() saves them in the collapsed stack format read by
+          flamegraph.pl and speedscope
+    '''
+    def __init__(self, thread_id, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval  = interval_ms / 1000
+        self.samples   = Counter()
+        self._stop     = threading.Event()
+        self._thread   = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def write(self, name) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, '%s-%s.folded' % (name, time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as fp:
+            for stack, count in self.samples.most_common():
+                fp.write('%s %d\n' % (stack, count))
+        return path
+
+class _metrics_handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def write_metrics_file(path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.write(REGISTRY.prometheus_text())
+    os.replace(tmp_path, path)
+
+def start_exporters(path=METRICS_FILE, port=METRICS_PORT, host=METRICS_HOST, interval=METRICS_INTERVAL):
+    '''
+    Start exporting metrics in the background, to path every interval
+    seconds and/or over http on port (if set)
+    '''
+    if path:
+        def write_loop():
+            while True:
+                try:
+                    write_metrics_file(path)
+                except OSError as e:
+                    print("could not write metrics to %s: %s" % (path, e))
+                time.sleep(interval)
+        threading.Thread(target=write_loop, name='metrics-file', daemon=True).start()
+        print("writing metrics to %s" % (path))
+
+    if port:
+        server = ThreadingHTTPServer((host, port), _metrics_handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        print("serving metrics on http://%s:%d/metrics" % (host, port))
@@ -0,0 +1,87 @@
+import asyncio, os
+from concurrent.futures import ThreadPoolExecutor
+
+# number of images rendered at once, how many more requests may wait for a
+# free renderer, and how long (in seconds) a request may take from being
+# submitted to being rendered
+RENDER_WORKERS = int(os.environ.get('RETRACEIT_RENDER_WORKERS', 2))
+RENDER_QUEUE   = int(os.environ.get('RETRACEIT_RENDER_QUEUE', 8))
+RENDER_TIMEOUT = float(os.environ.get('RETRACEIT_RENDER_TIMEOUT', 120))
+
+class RenderQueueFull(Exception):
+    '''
+    Raised when a job is submitted while every renderer is busy and the queue
+    is full
+    '''
+
+class render_executor:
+    '''
+    Runs render jobs (csv parsing, image generation and encoding) on a pool of
+    worker threads, so they do not block the event loop
+        - at most workers jobs run at once, and at most queue_size more may
+          wait for a worker; submitting beyond that raises RenderQueueFull
+        - jobs that take longer than timeout seconds (including time spent
+          queued) raise asyncio.TimeoutError. A job that has already started
+          cannot be interrupted, so it keeps its worker until it finishes.
+    Must only be used from a single event loop.
+    '''
+    def __init__(self, workers=RENDER_WORKERS, queue_size=RENDER_QUEUE, timeout=RENDER_TIMEOUT):
+        self.workers    = workers
+        self.queue_size = queue_size
+        self.timeout    = timeout
+        self.pool       = ThreadPoolExecutor(workers, thread_name_prefix='render')
+
+        # jobs submitted to the pool that have not finished yet (running or
+        # queued)
+        self.pending = 0
+        # jobs started by run_shared that have not finished yet, by key
+        self.shared = {}
+
+    def queued(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    async def run(self, func, *args, on_queued=None):
+        '''
+        Run func(*args) in the pool and return its result
+            - if the job has to wait for a worker, on_queued (a coroutine
+              function) is awaited with its position in the queue first, e.g.
+              to let the user know their request is queued
+        '''
+        if self.pending >= self.workers + self.queue_size:
+            raise RenderQueueFull()
+
+        loop = asyncio.get_running_loop()
+        job = self.pool.submit(func, *args)
+        self.pending += 1
+        # free the slot when the job actually finishes (or is cancelled before
+        # starting), not when its caller stops waiting
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._job_done))
+
+        position = self.pending - self.workers
+        if position > 0 and on_queued:
+            await on_queued(position)
+
+        return await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+
+    async def run_shared(self, key, func, *args, on_queued=None):
+        '''
+        Like run(), but calls made with the same key while a job for it is
+        still in progress share that job and its result (or exception),
+        rather than starting their own. key must identify the result, e.g. a
+        hash of the job's input and its parameters.
+            - on_queued is only called for the call that started the job
+        '''
+        task = self.shared.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.run(func, *args, on_queued=on_queued))
+            self.shared[key] = task
+            task.add_done_callback(lambda _: self.shared.pop(key, None))
+        # a caller that stops waiting (e.g. is cancelled) leaves the job
+        # running for the others
+        return await asyncio.shield(task)
+
+    def _job_done(self):
+        self.pending -= 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
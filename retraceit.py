@@ -1,7 +1,18 @@
-import re, datetime, os, io, gtfs
+import re, datetime, os, io, json, time, heapq, threading, gtfs, metrics
+from array import array
+from operator import itemgetter
 from PIL import Image, ImageDraw, ImageFont
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from enum import Enum
+from content_cache import lru_store
+
+try:
+    import numpy
+except ImportError:
+    # optional: tap_table aggregations fall back to pure Python loops
+    numpy = None
 
 MON_TO_NUM = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6, 
               'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
@@ -73,6 +84,18 @@ STN_BULLETS= {'Lougheed Stn': ['expo', 'mil'],
 
 NIGHTBUS_COLOUR = (0, 12, 66)
 RB_COLOUR       = (0, 133, 34)
+BUS_COLOUR      = (99, 130, 161)
+BG_COLOUR       = (0, 52, 86)
+BAR_COLOUR      = (30, 82, 116)
+
+# number of (text, width) results each text_fitter remembers
+FIT_CACHE_ENTRIES = 65536
+# number of header strips (one per image width) each render_cache remembers
+HEADER_CACHE_ENTRIES = 8
+
+# how far (in minutes) a scheduled departure may be from a bus tap for the tap
+# to be counted as a ride on its route, see route_counts()
+ROUTE_WINDOW_MINS = 5
 
 LINE_COLOURS={'99': (208, 65, 16),
               '099': (208, 65, 16),
@@ -96,79 +119,741 @@ LINE_COLOURS={'99': (208, 65, 16),
 
 Tap = namedtuple('Tap', ['time', 'stn', 'trans', 'product', 'am', 'bal',
                          'journey_id', 'location_disp', 'ordr_num',  'auth_code'])
+# all of the statistics the *_img functions draw, see analyze_history()
+HistoryStats = namedtuple('HistoryStats', ['stop_counts', 'hr_counts', 'month_counts',
+                                           'month_spend', 'total_taps', 'total_spend', 'bus_taps'])
+
+# GTFS feeds of other agencies (e.g. BC Transit's), besides TransLink's
+# (RETRACEIT_TRANSLINK_GTFSDIR): comma separated name=directory pairs
+# (RETRACEIT_GTFS_FEEDS), and/or a json file (RETRACEIT_GTFS_CONFIG), see
+# read_feed_config(). Once the feeds loaded add up to more than
+# RETRACEIT_GTFS_MEMORY_MB, the least recently used ones are unloaded (0: no
+# limit).
+def read_feed_config(config_path=None, feeds=None, memory_mb=None) -> (dict, float):
+   '''
+   Return the configured GTFS feeds, as {name: gtfs directory}, and the memory
+   budget of the loaded feeds in megabytes (0: no limit). Feeds are read from:
+       - the json file at config_path (default: RETRACEIT_GTFS_CONFIG), e.g.
+         {"feeds": {"bct_victoria": "/srv/gtfs/victoria"}, "memory_mb": 512}
+       - feeds: comma separated name=directory pairs (default:
+         RETRACEIT_GTFS_FEEDS)
+       - RETRACEIT_TRANSLINK_GTFSDIR, for the translink feed
+   in that order, later sources overriding earlier ones. memory_mb defaults to
+   RETRACEIT_GTFS_MEMORY_MB, then the config file's. The translink feed is
+   listed first. Names are lowercase letters, digits and underscores. Raises
+   ValueError if the configuration can't be read or is invalid.
+   '''
+   if config_path is None:
+       config_path = os.environ.get('RETRACEIT_GTFS_CONFIG')
+   if feeds is None:
+       feeds = os.environ.get('RETRACEIT_GTFS_FEEDS', '')
+   if memory_mb is None:
+       memory_mb = os.environ.get('RETRACEIT_GTFS_MEMORY_MB')
+
+   config = {}
+   if config_path:
+       try:
+           with open(config_path, encoding='utf-8') as fp:
+               config = json.load(fp)
+       except (OSError, ValueError) as e:
+           raise ValueError("could not read gtfs config %s: %s" % (config_path, e)) from e
+       if not isinstance(config, dict) or not isinstance(config.get('feeds', {}), dict):
+           raise ValueError("invalid gtfs config %s: expected {\"feeds\": {name: directory}}" % config_path)
+
+   feed_dirs = dict(config.get('feeds', {}))
+   for pair in feeds.split(','):
+       if pair.strip():
+           name, _, gtfs_dir = pair.partition('=')
+           feed_dirs[name.strip()] = gtfs_dir.strip()
+   if os.environ.get('RETRACEIT_TRANSLINK_GTFSDIR'):
+       feed_dirs['translink'] = os.environ['RETRACEIT_TRANSLINK_GTFSDIR']
+   if 'translink' in feed_dirs:
+       feed_dirs = {'translink': feed_dirs.pop('translink'), **feed_dirs}
+
+   for name, gtfs_dir in feed_dirs.items():
+       if not isinstance(name, str) or not re.fullmatch('[a-z][a-z0-9_]*', name) \
+               or not isinstance(gtfs_dir, str) or not gtfs_dir:
+           raise ValueError("invalid gtfs feed %r=%r" % (name, gtfs_dir))
+   try:
+       return feed_dirs, float(memory_mb if memory_mb is not None else config.get('memory_mb', 0))
+   except (TypeError, ValueError) as e:
+       raise ValueError("invalid gtfs memory budget %r" % (memory_mb,)) from e
+
+def _system_names() -> list:
+   '''
+   Return the names of the configured feeds other than translink, or none if
+   the configuration is invalid: importing this module must not fail on it,
+   retraceit_db() reports the error when the bot starts
+   '''
+   try:
+       return [name for name in read_feed_config()[0] if name != 'translink']
+   except ValueError:
+       return []
+
+# one member per configured feed. TRANSLINK is always defined, as it is the
+# system Compass exports come from.
+system_t = Enum('system_t', [('TRANSLINK', 0)] +
+                [(name.upper(), idx) for idx, name in enumerate(_system_names(), 1)],
+                module=__name__)
+
+class gtfs_feed:
+   '''
+   The GTFS data of a transit system, which can be reloaded while it is in use
+       - the feed is loaded on first use, or by load()
+       - use() leases the current GTFS tuple for the length of a with block
+       - reload() builds a new GTFS tuple (and its derived indexes) while the
+         current one keeps serving requests, then swaps it in. The old copy is
+         released once the last lease on it ends.
+       - unload() frees the feed while no render is using it; it is loaded
+         again on next use
+       - footprint is the memory held by the loaded copy (see
+         gtfs.gtfs_footprint), or 0 when the feed is not loaded
+       - fingerprint is that of the files the current (or, once unloaded,
+         the last) copy was read from, or None before the first load
+   '''
+   def __init__(self, name, gtfs_dir):
+       self.name        = name
+       self.gtfs_dir    = gtfs_dir
+       self.footprint   = 0
+       self.fingerprint = None
+       # report of the last reload, see reload()
+       self.last_reload = None
+
+       self._lock      = threading.Lock()
+       self._loading   = threading.Lock()
+       self._reloading = threading.Lock()
+       self._current   = None
+       self._retired   = []
+
+   def loaded(self) -> bool:
+       return self._current is not None
+
+   def load(self):
+       '''
+       Load the feed, unless it already is. Other threads calling load() (or
+       use()) at the same time wait for it to finish.
+       '''
+       with self._loading:
+           if self._current is None:
+               print("reading %s gtfs data..." % (self.name))
+               with metrics.span('gtfs_load'):
+                   fingerprint = gtfs.gtfs_fingerprint(self.gtfs_dir)
+                   copy = _read_feed_copy(self.gtfs_dir, fingerprint)
+                   self._set_footprint(gtfs.gtfs_footprint(copy.gtfs))
+                   self._current = copy
+                   self.fingerprint = fingerprint
+
+   @contextmanager
+   def use(self):
+       while True:
+           with self._lock:
+               copy = self._current
+               if copy is not None:
+                   copy.users += 1
+                   break
+           # not loaded yet, or unloaded since
+           self.load()
+       try:
+           yield copy.gtfs
+       finally:
+           with self._lock:
+               copy.users -= 1
+               if copy.retired and not copy.users:
+                   self._release(copy)
+
+   def reload(self, force=False) -> dict:
+       '''
+       Reload the feed from gtfs_dir (unless its files have not changed and
+       force is not set) and swap it in, returning a report of:
+           - duration_s: how long it took to build the new copy
+           - peak_rss_mb: the peak RSS of the process while the old and new
+             copies were both loaded. If renders were still using the old copy
+             when this returns, the report (self.last_reload) is updated once
+             it is released.
+           - pending_users: the number of renders still using the old copy
+       Returns None if another reload is already in progress.
+       '''
+       if not self._reloading.acquire(blocking=False):
+           return None
+
+       try:
+           self.load()
+           fingerprint = gtfs.gtfs_fingerprint(self.gtfs_dir)
+           if not force and fingerprint == self._current.fingerprint:
+               return {'changed': False}
+
+           print("reloading %s gtfs data..." % (self.name))
+           report = {'changed': True, 'started': time.time()}
+           sampler = metrics.rss_sampler()
+           sampler.start()
+
+           start = time.perf_counter()
+           with metrics.span('gtfs_reload'):
+               new_copy = _read_feed_copy(self.gtfs_dir, fingerprint)
+           report['duration_s'] = time.perf_counter() - start
+           self._set_footprint(gtfs.gtfs_footprint(new_copy.gtfs))
+
+           with self._lock:
+               old_copy, self._current = self._current, new_copy
+               self.fingerprint = fingerprint
+               old_copy.retired = True
+               old_copy.sampler, old_copy.report = sampler, report
+               report['pending_users'] = old_copy.users
+               self.last_reload = report
+               if old_copy.users:
+                   self._retired.append(old_copy)
+               else:
+                   self._release(old_copy)
+               report['peak_rss_mb'] = sampler.peak / (1 << 20)
+
+           print("reloaded %s gtfs data in %.1fs (%d renders still using the old copy)" %
+                 (self.name, report['duration_s'], report['pending_users']))
+           return dict(report)
+       finally:
+           self._reloading.release()
+
+   def unload(self) -> bool:
+       '''
+       Free the loaded copy of the feed, returning False (and keeping it) if a
+       render is using it or it is being reloaded
+       '''
+       # held until the copy is cleared, so that a reload cannot start (and
+       # find no current copy) in between
+       if not self._reloading.acquire(blocking=False):
+           return False
+       try:
+           with self._lock:
+               copy = self._current
+               if copy is None or copy.users:
+                   return copy is None
+               self._current = None
+               copy.gtfs = None
+               copy.strings.release()
+       finally:
+           self._reloading.release()
+
+       print("unloaded %s gtfs data (%.0fMB)" % (self.name, self.footprint / (1 << 20)))
+       self._set_footprint(0)
+       return True
+
+   def _set_footprint(self, footprint):
+       self.footprint = footprint
+       metrics.REGISTRY.set('retraceit_gtfs_footprint_bytes', footprint, system=self.name)
+
+   def _release(self, copy):
+       # called with self._lock held, once the last render using copy is done
+       copy.gtfs = None
+       copy.strings.release()
+       if copy in self._retired:
+           self._retired.remove(copy)
+
+       peak = copy.sampler.stop()
+       copy.report['peak_rss_mb'] = peak / (1 << 20)
+       copy.report['released'] = time.time()
+       metrics.REGISTRY.set('retraceit_gtfs_reload_peak_rss_bytes', peak, system=self.name)
+       print("released old %s gtfs data, peak rss during reload: %.0fMB" % (self.name, peak / (1 << 20)))
+
+class _feed_copy:
+   '''
+   One loaded copy of a gtfs_feed, the strings it holds in gtfs.STRINGS, and
+   the number of renders using it
+   '''
+   def __init__(self, gtfs_tup, fingerprint, strings):
+       self.gtfs        = gtfs_tup
+       self.fingerprint = fingerprint
+       self.strings     = strings
+       self.users       = 0
+       self.retired     = False
+       self.sampler     = None
+       self.report      = None
+
+def _read_feed_copy(gtfs_dir, fingerprint) -> _feed_copy:
+   strings = gtfs.STRINGS.owner()
+   try:
+       return _feed_copy(gtfs.read_gtfs_data(gtfs_dir, strings=strings), fingerprint, strings)
+   except BaseException:
+       strings.release()
+       raise
+
+class feed_registry(Mapping):
+   '''
+   The gtfs_feeds of the configured systems, by system_t
+       - feeds are loaded on first use (or by load()), and the footprint of
+         each loaded feed is tracked
+       - once the footprints of the loaded feeds add up to more than
+         memory_budget bytes (0: no limit), the least recently used ones are
+         unloaded until they fit. Feeds renders are using are skipped, and
+         checked again once the renders finish.
+       - strings repeated within and across feeds are shared, see gtfs.STRINGS
+   '''
+   def __init__(self, feeds: dict, memory_budget=0):
+       self.feeds         = feeds
+       self.memory_budget = memory_budget
+       # loaded systems, least recently used first
+       self._lru  = OrderedDict()
+       self._lock = threading.Lock()
+
+   def __getitem__(self, system) -> gtfs_feed:
+       return self.feeds[system]
+
+   def __iter__(self):
+       return iter(self.feeds)
+
+   def __len__(self):
+       return len(self.feeds)
+
+   def footprint(self) -> int:
+       return sum([feed.footprint for feed in self.feeds.values()])
+
+   def load(self, system):
+       self.feeds[system].load()
+       self._touch(system)
+
+   @contextmanager
+   def use(self, system):
+       '''
+       Lease the current GTFS tuple of system for the length of a with block
+       (see gtfs_feed.use)
+       '''
+       try:
+           with self.feeds[system].use() as gtfs_tup:
+               self._touch(system)
+               yield gtfs_tup
+       finally:
+           # feeds kept over the budget because they were in use may be
+           # unloaded now
+           self.trim()
+
+   def reload(self, system, force=False) -> dict:
+       report = self.feeds[system].reload(force)
+       self._touch(system)
+       return report
+
+   def warm_up(self):
+       '''
+       Load feeds, in the order they were configured, until one does not fit
+       in the memory budget
+       '''
+       for system, feed in self.feeds.items():
+           feed.load()
+           if self.memory_budget and self.footprint() > self.memory_budget:
+               # rather than unloading the feeds loaded before it
+               feed.unload()
+               break
+           self._touch(system)
+
+   def _touch(self, system):
+       with self._lock:
+           self._lru[system] = True
+           self._lru.move_to_end(system)
+       self.trim()
+
+   def trim(self):
+       '''
+       Unload the least recently used feeds until the loaded ones fit in the
+       memory budget
+       '''
+       if not self.memory_budget or self.footprint() <= self.memory_budget:
+           return
 
-class system_t(Enum):
-    TRANSLINK = 0
+       with self._lock:
+           for system in list(self._lru):
+               if self.footprint() <= self.memory_budget:
+                   break
+               feed = self.feeds[system]
+               if feed.unload():
+                   del self._lru[system]
+                   metrics.REGISTRY.inc('retraceit_gtfs_unloads_total', system=feed.name)
+
+class image_dir:
+   '''
+   The png and jpg images in a directory, by file name without extension.
+   Each image is decoded (to RGBA, the mode gen_img composites them in) on
+   first use.
+   '''
+   def __init__(self, img_dir):
+       self.img_dir = img_dir
+       self._paths  = None
+       self._imgs   = {}
+       self._lock   = threading.Lock()
+
+   def paths(self) -> dict:
+       if self._paths is None:
+           paths = {}
+           for fname in os.listdir(self.img_dir):
+               name, ext = os.path.splitext(fname)
+               if ext == '.png' or ext == '.jpg':
+                   paths[name] = os.path.join(self.img_dir, fname)
+           self._paths = paths
+       return self._paths
+
+   def __getitem__(self, name) -> Image:
+       img = self._imgs.get(name)
+       if img is None:
+           with self._lock:
+               if name not in self._imgs:
+                   self._imgs[name] = Image.open(self.paths()[name]).convert('RGBA')
+               img = self._imgs[name]
+       return img
+
+   def __contains__(self, name):
+       return name in self.paths()
+
+   def keys(self):
+       return self.paths().keys()
 
 class retraceit_db:
+   '''
+   The GTFS feeds, bullets, fonts and logo used to draw images. Nothing is
+   loaded up front: GTFS feeds are loaded on first use (see feed_registry),
+   bullets by name, and fonts per size. warm_up() loads everything ahead of
+   time, e.g. in the background while the bot connects.
+   '''
    def __init__(self):
-        self.gtfs = {}
-
         print("INITALIZING GTFS DATABASE")
-        tl_gtfs_dir = os.environ.get('RETRACEIT_TRANSLINK_GTFSDIR')
-        if tl_gtfs_dir:
-            print("reading TransLink data...")
-            self.gtfs[system_t.TRANSLINK] = gtfs.read_gtfs_data(tl_gtfs_dir)
+        feed_dirs, memory_mb = read_feed_config()
+        feeds = {}
+        for name, gtfs_dir in feed_dirs.items():
+            if name.upper() not in system_t.__members__:
+                # configured after system_t was defined
+                print("ignoring gtfs feed %s: not configured at startup" % (name))
+                continue
+            feeds[system_t[name.upper()]] = gtfs_feed(name, gtfs_dir)
+        self.feeds = feed_registry(feeds, int(memory_mb * (1 << 20)))
 
-        print("LOADING ROUTE BULLETS")
         # bullets should be 54x54px
-        self.bullets = {}
-        img_dir = os.environ.get("RETRACEIT_IMGDIR")
-        for bullet_fname in os.listdir(img_dir):
-            bullet_name, ext = os.path.splitext(bullet_fname)
-            if ext != '.png' and ext != '.jpg':
-                continue
-            self.bullets[bullet_name] = Image.open(os.path.join(img_dir, bullet_fname))
+        self.bullets = image_dir(os.environ.get("RETRACEIT_IMGDIR"))
 
-        print("LOADING FONTS")
-        fnt_file = os.environ.get("RETRACEIT_FNTFILE")
-        assert os.path.exists(fnt_file)
-        self.fnt = ImageFont.truetype(fnt_file, 40)
-        self.title_fnt = ImageFont.truetype(fnt_file, 60)
+        self.fnt_file = os.environ.get("RETRACEIT_FNTFILE")
+        assert self.fnt_file and os.path.exists(self.fnt_file)
+        self.fonts = {}
 
-        logo_path = os.environ.get("RETRACEIT_HEADER_LOGO")
-        if logo_path:
-            print("LOADING HEADER LOGO")
-            logo       = Image.open(logo_path)
-            logo_sized = logo.resize((160, 160))
-            self.logo = logo_sized
+        self.logo_path = os.environ.get("RETRACEIT_HEADER_LOGO")
+        self._logo = None
+
+        self.sprites = render_cache(self)
+        self.fitters = {}
+        self._lock = threading.Lock()
 
         print("DATABASE INIT COMPLETE")
 
-def load_csv(fp) -> list:
+   def font(self, size) -> ImageFont:
+        '''
+        Return the font at the given size, loading it on first use
+        '''
+        fnt = self.fonts.get(size)
+        if fnt is None:
+            with self._lock:
+                if size not in self.fonts:
+                    self.fonts[size] = ImageFont.truetype(self.fnt_file, size)
+                fnt = self.fonts[size]
+        return fnt
+
+   @property
+   def fnt(self) -> ImageFont:
+        return self.font(40)
+
+   @property
+   def title_fnt(self) -> ImageFont:
+        return self.font(60)
+
+   @property
+   def logo(self) -> Image:
+        '''
+        The header logo, resized to 160x160, or None if there is none
+        '''
+        if self._logo is None and self.logo_path:
+            with self._lock:
+                if self._logo is None:
+                    self._logo = Image.open(self.logo_path).convert('RGBA').resize((160, 160))
+        return self._logo
+
+   def warm_up(self, background=True):
+        '''
+        Load the GTFS feeds, fonts, bullets and logo now rather than on first
+        use. If background is set, they are loaded in a new thread, which is
+        returned.
+        '''
+        def load_all():
+            start = time.perf_counter()
+            for size in (40, 60):
+                self.font(size)
+            # loaded on first access
+            self.logo
+            for name in self.bullets.keys():
+                self.bullets[name]
+            self.feeds.warm_up()
+            print("warm up complete in %.1fs" % (time.perf_counter() - start))
+
+        if not background:
+            load_all()
+            return None
+
+        thread = threading.Thread(target=load_all, name='warm-up', daemon=True)
+        thread.start()
+        return thread
+
+   def use_gtfs(self, system: system_t):
+        '''
+        Lease the current GTFS tuple of system for the length of a with block
+        (see gtfs_feed.use)
+        '''
+        return self.feeds.use(system)
+
+   def reload_gtfs(self, system: system_t, force=False) -> dict:
+        '''
+        Reload the GTFS feed of system without interrupting renders (see
+        gtfs_feed.reload)
+        '''
+        return self.feeds.reload(system, force)
+
+   def fitter(self, fnt) -> 'text_fitter':
+        '''
+        Return the text_fitter for the given font (e.g. self.fnt)
+        '''
+        if fnt not in self.fitters:
+            self.fitters[fnt] = text_fitter(fnt)
+        return self.fitters[fnt]
+
+class render_cache:
+   '''
+   Pre-rendered pieces of the images drawn by gen_img, so that drawing a chart
+   is mostly a matter of pasting them. Each piece is rendered on first use:
+       - badges: route number badges, per route number
+       - bullet_rows: the row of service bullets for each station in
+         STN_BULLETS
+       - headers: the header strip (background and logo), for the
+         HEADER_CACHE_ENTRIES image widths used most recently
+   '''
+   def __init__(self, db: retraceit_db):
+       self.db          = db
+       self.badges      = {}
+       self.bullet_rows = {}
+       self.headers     = lru_store(HEADER_CACHE_ENTRIES)
+
+   def badge(self, rt_num) -> Image:
+       '''
+       Return the badge for the given route number, or None if its text does
+       not fit inside the badge (in which case it has to be drawn in place
+       with draw_badge, as it overlaps the image behind it)
+       '''
+       if rt_num not in self.badges:
+           badge = Image.new('RGBA', (73, 55))
+           d = ImageDraw.Draw(badge)
+           draw_badge(d, 0, 0, rt_num, self.db.fnt)
+
+           left, top, right, bottom = d.multiline_textbbox((37, 25), str(rt_num), font=self.db.fnt,
+                                                           align='center', anchor='mm')
+           fits = left >= 0 and top >= 0 and right <= badge.width and bottom <= badge.height
+           self.badges[rt_num] = badge if fits else None
+
+       return self.badges[rt_num]
+
+   def bullet_row(self, stn_name) -> Image:
+       '''
+       Return the bullets of the given station in STN_BULLETS, laid out as in
+       gen_img, on a transparent background
+       '''
+       if stn_name not in self.bullet_rows:
+           bullets = [self.db.bullets[bullet] for bullet in STN_BULLETS[stn_name]]
+           row = Image.new('RGBA', (60*(len(bullets)-1) + bullets[-1].width,
+                                    max([bullet.height for bullet in bullets])))
+           for bullet_idx, bullet in enumerate(bullets):
+               row.paste(bullet, (60*bullet_idx, 0))
+           self.bullet_rows[stn_name] = row
+
+       return self.bullet_rows[stn_name]
+
+   def header(self, width) -> Image:
+       '''
+       Return the background of the header of an image of the given width,
+       with the logo drawn on it
+       '''
+       header = self.headers.get(width)
+       if header is None:
+           header = Image.new('RGBA', (width, self.db.logo.height), color=BG_COLOUR)
+           header.alpha_composite(self.db.logo, dest=(0, 0))
+           self.headers.put(width, header)
+
+       return header
+
+class text_fitter:
+   '''
+   Shortens text to fit in a given width in a font, the way gen_img always
+   has: dropping characters from the end and adding '...' until it fits.
+       - widths are estimated from cached per-character advances and pair
+         kerning, so the longest prefix that fits is found by binary search
+         rather than by measuring every shorter candidate. Only the full
+         text and the final candidates are measured exactly, so the result
+         is the same as measuring every candidate.
+       - results are memoized per (text, width)
+   '''
+   def __init__(self, fnt):
+       self.fnt      = fnt
+       self.advances = {}
+       self.kerning  = {}
+       self.fitted   = lru_store(FIT_CACHE_ENTRIES)
+       self._draw    = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+   def length(self, text) -> float:
+       return self._draw.textlength(text, font=self.fnt)
+
+   def fit(self, text, avail_width) -> str:
+       '''
+       Return text, or the longest prefix of it followed by '...' that is at
+       most avail_width wide. Text that cannot fit at all is returned as
+       '...', and text of 3 characters or less is never shortened.
+       '''
+       key = (text, avail_width)
+       fitted = self.fitted.get(key)
+       if fitted is None:
+           fitted = self._fit(text, avail_width)
+           self.fitted.put(key, fitted)
+       return fitted
+
+   def _fit(self, text, avail_width) -> str:
+       if len(text) <= 3 or self.length(text) <= avail_width:
+           return text
+
+       # estimated widths of text[:n] + '...', for n from 0 to len(text)-4
+       # (shortening always drops at least 4 characters to make room for the
+       # dots)
+       max_len = len(text) - 4
+       prefix_widths = [0]
+       for idx in range(max_len):
+           prefix_widths.append(prefix_widths[-1] + self._advance(text[idx]) +
+                                (self._kern(text[idx-1], text[idx]) if idx else 0))
+       dots_width = self._advance('.')*3 + self._kern('.', '.')*2
+
+       def est_width(n):
+           return prefix_widths[n] + dots_width + (self._kern(text[n-1], '.') if n else 0)
+
+       # largest n whose estimate fits, i.e. the first candidate that fits
+       # when shortening one character at a time
+       lo, hi = 0, max_len
+       while lo < hi:
+           mid = (lo + hi + 1) // 2
+           if est_width(mid) <= avail_width: lo = mid
+           else: hi = mid - 1
+
+       # the estimate is exact for simple layouts, but check the result
+       # against the real text length in case shaping changed it
+       n = lo
+       while n > 0 and self.length(text[:n] + '...') > avail_width:
+           n -= 1
+       while n < max_len and self.length(text[:n+1] + '...') <= avail_width:
+           n += 1
+
+       return text[:n] + '...'
+
+   def _advance(self, char) -> float:
+       if char not in self.advances:
+           self.advances[char] = self.length(char)
+       return self.advances[char]
+
+   def _kern(self, left, right) -> float:
+       pair = left + right
+       if pair not in self.kerning:
+           self.kerning[pair] = self.length(pair) - self._advance(left) - self._advance(right)
+       return self.kerning[pair]
+
+def draw_badge(d: ImageDraw, xpos, ypos, rt_num, fnt):
+   rect_colour = LINE_COLOURS[rt_num] if rt_num in LINE_COLOURS else BUS_COLOUR
+
+   d.rectangle( (xpos, ypos, xpos+72, ypos+54 ), fill=rect_colour)
+   d.multiline_text((xpos+37, ypos+25), str(rt_num), font=fnt,
+                    fill='white', align='center', anchor='mm')
+
+# compass history timestamps (e.g. Mar-12-2024 03:04 AM), and the station at
+# the end of a transaction description
+TIME_RE = re.compile(r"(\w{3})-(\d\d)-(\d{4})\s(\d\d):(\d\d) ([AP])M")
+STN_RE  = re.compile(r".*\sat\s+(?:(.*Stn)|Bus Stop\s(\d+)|(.*Station)|(Lonsdale Quay))\s*")
+
+@metrics.span('load_csv')
+def load_csv(fp, is_new=None) -> list:
     '''
-    Mar-12-2024 03:04 AM
+    Parse the taps in the compass log pointed to by fp, returning a list of Tap
+    tuples
+        - if is_new is given, it is called with the raw time, transaction,
+          order number and auth code of each row that would be kept, before
+          its time and amounts are built. Rows it returns False for are
+          skipped, and reading stops at the first row it returns None for:
+          the rest of the file is not parsed at all (see tap_store).
+        - see _tap_rows for how rows are parsed
     '''
     results = []
 
-    for line in gtfs.grab_csv_lines(fp):
-        time, trans, prod, li, am, bal, jID, locDisp, _, _, _, ordNum, authCode, tot = line.split(',')
-
-        time_grps = re.match("(\w{3})-(\d\d)-(\d{4})\s(\d\d):(\d\d) ([AP])M", time)
-        if not time_grps:
-            continue
-
-        month, day, year, hr_12, mins, ampm = time_grps.groups()
-        hr_24 = int(hr_12) + 12 if (ampm == 'P') else int(hr_12)
-        if hr_12 == '12': hr_24 -= 12
-        day = int(day)
-        mins = int(mins)
-        year = int(year)
+    for date, clock_time, stn, trans, prod, am, bal, jID, locDisp, ordNum, authCode in _tap_rows(fp, is_new):
+        processed_time = datetime.datetime(*date, *clock_time)
         am = float(am.replace('$', '', 1))
         bal = float(bal.replace('$', '', 1))
-        mon_num = MON_TO_NUM[month]
-        processed_time = datetime.datetime(year, mon_num, day, hr_24, mins)
+
+        results.append( Tap(processed_time, stn, trans, prod, am, bal,
+                            jID, locDisp, ordNum, authCode) )
+    return results
+
+def _tap_rows(fp, is_new=None):
+    '''
+    Yield (date, clock_time, stn, trans, prod, am, bal, jID, locDisp, ordNum,
+    authCode) for each tap in the compass log pointed to by fp, where date is
+    (year, month, day), clock_time is (hour, minute), and the rest are the
+    raw fields of the row (see load_csv for is_new)
+        - timestamps look like Mar-12-2024 03:04 AM. They have a fixed layout,
+          so the date (first 12 chars) and time of day (next 8) are each only
+          parsed once and looked up for later rows
+        - stations are only searched for once per distinct transaction text
+    '''
+    dates, clock_times, stns = {}, {}, {}
+
+    # callers that may stop early only split the records they read
+    for line in gtfs.iter_csv_lines(fp) if is_new else gtfs.grab_csv_lines(fp):
+        time, trans, prod, li, am, bal, jID, locDisp, _, _, _, ordNum, authCode, tot = line.split(',')
 
         # for now, just skip purchase transactions (since monthly pass purchases
         # don't have a dollar amount)
         if 'Purchase' in trans or 'Loaded' in trans: continue
-        stn_search = re.search(r".*\sat\s+(?:(.*Stn)|Bus Stop\s(\d+)|(.*Station)|(Lonsdale Quay))\s*", trans)
-        stn = "".join([group for group in stn_search.groups() if group]) if stn_search else None
+
+        date = dates.get(time[:12])
+        clock_time = clock_times.get(time[12:20])
+        if date is None or clock_time is None:
+            time_parts = _time_parts(time)
+            if not time_parts:
+                continue
+            date, clock_time = time_parts
+            dates[time[:12]], clock_times[time[12:20]] = time_parts
+
+        if trans in stns:
+            stn = stns[trans]
+        else:
+            stn_search = STN_RE.search(trans)
+            stn = stns[trans] = "".join([group for group in stn_search.groups() if group]) if stn_search else None
         if not stn: continue
+        if is_new:
+            new = is_new(time, trans, ordNum, authCode)
+            if new is None: return
+            if not new: continue
 
-        results.append( Tap(processed_time, stn, trans, prod, am, bal,
-                            jID, locDisp, ordNum, authCode) )
-    return results
+        yield date, clock_time, stn, trans, prod, am, bal, jID, locDisp, ordNum, authCode
+
+def _time_parts(time):
+    # ((year, month, day), (hour, minute)) of a compass history timestamp, or
+    # None if it is not one
+    time_grps = TIME_RE.match(time)
+    if not time_grps:
+        return None
+
+    month, day, year, hr_12, mins, ampm = time_grps.groups()
+    hr_24 = int(hr_12) + 12 if (ampm == 'P') else int(hr_12)
+    if hr_12 == '12': hr_24 -= 12
+    return (int(year), MON_TO_NUM[month], int(day)), (hr_24, int(mins))
+
+def parse_tap_time(time) -> datetime.datetime:
+    '''
+    Parse a compass history timestamp (e.g. Mar-12-2024 03:04 AM), returning
+    None if it is not one
+    '''
+    time_parts = _time_parts(time)
+    return datetime.datetime(*time_parts[0], *time_parts[1]) if time_parts else None
 
 def get_hr_counts(trips):
     '''
@@ -214,16 +899,238 @@ def get_month_counts(trips, spend=False):
 
     return results
 
-def get_top_counts(counts):
+def get_top_counts(counts, num=None):
+    '''
+    Return the (key, count) items of counts in decreasing order of count
+    (keeping the order of counts for ties), or only the first num of them
+        - with num, the top items are picked with a heap in O(n log num)
+          rather than by sorting every item
+    '''
+    if num is not None and num < len(counts):
+        return heapq.nlargest(num, counts.items(), key=itemgetter(1))
     return sorted(list(counts.items()), key=lambda x: -x[1])
 
-def print_top_counts(top_counts, stop_names = {}, width = 30):
-    print("Stn/stop".ljust(width) + "| Count ")
-    print("-"* width + "+-------")
+# tap times in a tap_table are minutes since this (local) time
+TAP_EPOCH = datetime.datetime(1970, 1, 1)
+
+class tap_table:
+   '''
+   Columnar store of the taps of a compass log, for histories of hundreds of
+   thousands of taps: no Tap tuple or datetime is kept per tap, and
+   statistics are computed over whole columns
+       - minutes: the time of each tap, in minutes since TAP_EPOCH
+       - amounts: the amount of each tap, in dollars (negative for fares)
+       - stns: the station/stop of each tap, as an index into stations
+         (interned in the order they first appear)
+   Columns are numpy arrays (int64, float64 and int32) if numpy is installed,
+   in which case the group-bys are vectorized. Otherwise they are arrays of
+   the same types, and the group-bys are pure Python loops.
+   '''
+   def __init__(self, minutes, amounts, stns, stations):
+       self.minutes  = minutes
+       self.amounts  = amounts
+       self.stns     = stns
+       self.stations = stations
+
+   def __len__(self):
+       return len(self.minutes)
+
+   def between(self, start=None, end=None) -> 'tap_table':
+       '''
+       Return a table of the taps from start (inclusive) to end (exclusive),
+       which are datetimes or dates (None for no limit)
+       '''
+       lo = _tap_minutes(start) if start is not None else None
+       hi = _tap_minutes(end) if end is not None else None
+
+       if numpy is not None:
+           keep = numpy.ones(len(self), dtype=bool)
+           if lo is not None: keep &= self.minutes >= lo
+           if hi is not None: keep &= self.minutes < hi
+           return tap_table(self.minutes[keep], self.amounts[keep], self.stns[keep], self.stations)
+
+       rows = [idx for idx, minute in enumerate(self.minutes)
+               if (lo is None or minute >= lo) and (hi is None or minute < hi)]
+       return tap_table(array('q', [self.minutes[idx] for idx in rows]),
+                        array('d', [self.amounts[idx] for idx in rows]),
+                        array('i', [self.stns[idx] for idx in rows]), self.stations)
+
+   def stop_counts(self) -> dict:
+       '''
+       Return a dict mapping stations to their number of taps, in the order
+       they first appear (as get_counts does)
+       '''
+       if numpy is not None:
+           codes, first, counts = numpy.unique(self.stns, return_index=True, return_counts=True)
+           order = numpy.argsort(first, kind='stable')
+           return {self.stations[code]: count for code, count in zip(codes[order].tolist(), counts[order].tolist())}
+
+       counts = {}
+       for code in self.stns:
+           counts[code] = counts.get(code, 0) + 1
+       return {self.stations[code]: count for code, count in counts.items()}
+
+   def hr_counts(self) -> dict:
+       '''
+       Return a dict mapping each hour of the day to its number of taps (as
+       get_hr_counts does)
+       '''
+       if numpy is not None:
+           return dict(enumerate(numpy.bincount(self.minutes // 60 % 24, minlength=24).tolist()))
+
+       counts = {hr: 0 for hr in range(0, 24)}
+       for minute in self.minutes:
+           counts[minute // 60 % 24] += 1
+       return counts
+
+   def month_stats(self) -> (dict, dict):
+       '''
+       Return dicts mapping calendar months to their number of taps and to
+       their total spend (as get_month_counts does), in the order the months
+       first appear
+       '''
+       if numpy is not None:
+           # months since 1970-01
+           months = self.minutes.astype('datetime64[m]').astype('datetime64[M]').astype(numpy.int64)
+           uniq, first, inverse = numpy.unique(months, return_index=True, return_inverse=True)
+           counts = numpy.bincount(inverse, minlength=len(uniq)).tolist()
+           spend = numpy.bincount(inverse, weights=-self.amounts, minlength=len(uniq)).tolist()
+           order = numpy.argsort(first, kind='stable').tolist()
+           keys = ["%s-%s" % (1970 + month // 12, month % 12 + 1) for month in uniq.tolist()]
+           return {keys[idx]: counts[idx] for idx in order}, {keys[idx]: spend[idx] for idx in order}
+
+       month_counts, month_spend, month_keys = {}, {}, {}
+       for minute, amount in zip(self.minutes, self.amounts):
+           day = minute // 1440
+           month_str = month_keys.get(day)
+           if month_str is None:
+               date = TAP_EPOCH + datetime.timedelta(days=day)
+               month_str = month_keys[day] = "%s-%s" % (date.year, date.month)
+           month_counts[month_str] = month_counts.get(month_str, 0) + 1
+           month_spend[month_str] = month_spend.get(month_str, 0) + -1*amount
+       return month_counts, month_spend
+
+   def bus_taps(self) -> dict:
+       '''
+       Return the time of every tap at a bus stop, by stop number (see
+       HistoryStats)
+       '''
+       bus_codes = set([code for code, stn in enumerate(self.stations) if stn.isdigit()])
+       if not bus_codes:
+           return {}
+
+       if numpy is not None:
+           rows = numpy.flatnonzero(numpy.isin(self.stns, list(bus_codes))).tolist()
+       else:
+           rows = [idx for idx, code in enumerate(self.stns) if code in bus_codes]
+
+       bus_taps = {}
+       for idx in rows:
+           bus_taps.setdefault(self.stations[self.stns[idx]], []).append(
+               TAP_EPOCH + datetime.timedelta(minutes=int(self.minutes[idx])))
+       return bus_taps
+
+   def stats(self) -> HistoryStats:
+       '''
+       Compute the statistics of analyze_history (see tally_taps), without
+       applying cleanup_data to the stop counts
+       '''
+       month_counts, month_spend = self.month_stats()
+       if numpy is not None:
+           total_spend = -float(self.amounts.sum())
+       else:
+           total_spend = 0
+           for amount in self.amounts:
+               total_spend += -1*amount
+
+       return HistoryStats(self.stop_counts(), self.hr_counts(), month_counts, month_spend,
+                           len(self), total_spend, self.bus_taps())
+
+def _tap_minutes(time) -> int:
+    # minutes since TAP_EPOCH of a datetime or date
+    if not isinstance(time, datetime.datetime):
+        time = datetime.datetime(time.year, time.month, time.day)
+    return (time - TAP_EPOCH) // datetime.timedelta(minutes=1)
+
+@metrics.span('load_tap_table')
+def load_tap_table(fp) -> tap_table:
+    '''
+    Parse the taps in the compass log pointed to by fp (see load_csv) into a
+    tap_table
+    '''
+    minutes, amounts, stns = array('q'), array('d'), array('i')
+    stations, station_idx, days = [], {}, {}
+
+    for date, clock_time, stn, _, _, am, _, _, _, _, _ in _tap_rows(fp):
+        day = days.get(date)
+        if day is None:
+            day = days[date] = (datetime.date(*date) - TAP_EPOCH.date()).days * 1440
+        code = station_idx.get(stn)
+        if code is None:
+            code = station_idx[stn] = len(stations)
+            stations.append(stn)
+
+        minutes.append(day + clock_time[0]*60 + clock_time[1])
+        amounts.append(float(am.replace('$', '', 1)))
+        stns.append(code)
+
+    if numpy is not None:
+        minutes, amounts, stns = (numpy.frombuffer(col, dtype=col.typecode) for col in (minutes, amounts, stns))
+    return tap_table(minutes, amounts, stns, stations)
+
+def analyze_history(fp, start=None, end=None) -> HistoryStats:
+    '''
+    Parse the compass log pointed to by fp once, and compute every statistic
+    drawn by the *_img functions over its taps (see tap_table):
+        - stop_counts: as returned by get_counts (with cleanup_data applied)
+        - hr_counts: as returned by get_hr_counts
+        - month_counts/month_spend: as returned by get_month_counts with
+          spend=False/True
+        - total_taps/total_spend: the totals of the above
+        - bus_taps: the time of every tap at a bus stop, by stop number (see
+          route_counts)
+    Only the taps from start to end (datetimes or dates, see
+    tap_table.between) are counted if either is given.
+    '''
+    taps = load_tap_table(fp)
+    if start is not None or end is not None:
+        taps = taps.between(start, end)
+    stats = taps.stats()
+    cleanup_data(stats.stop_counts)
+    return stats
+
+def tally_taps(trips) -> HistoryStats:
+    '''
+    Compute the statistics of analyze_history for the given list of Tap
+    tuples, without applying cleanup_data to the stop counts
+    '''
+    stop_counts, month_counts, month_spend, bus_taps = {}, {}, {}, {}
+    hr_counts = {hr: 0 for hr in range(0, 24)}
+    total_taps = total_spend = 0
+
+    for trip in trips:
+        date = trip.time
+        month_str = "%s-%s" % (date.year, date.month)
+
+        stop_counts[trip.stn] = stop_counts.get(trip.stn, 0) + 1
+        hr_counts[date.hour] += 1
+        month_counts[month_str] = month_counts.get(month_str, 0) + 1
+        month_spend[month_str] = month_spend.get(month_str, 0) + -1*trip.am
+        total_taps += 1
+        total_spend += -1*trip.am
+        if trip.stn.isdigit():
+            bus_taps.setdefault(trip.stn, []).append(date)
+
+    return HistoryStats(stop_counts, hr_counts, month_counts, month_spend,
+                        total_taps, total_spend, bus_taps)
+
+def print_top_counts(top_counts, stop_names = {}, width = 30, file = None):
+    print("Stn/stop".ljust(width) + "| Count ", file=file)
+    print("-"* width + "+-------", file=file)
     
     for place, count in top_counts:
         place = stop_names[place] if place in stop_names else place
-        print(shorten(place, width).rjust(width) + '|' + str(count).rjust(7))
+        print(shorten(place, width).rjust(width) + '|' + str(count).rjust(7), file=file)
 
 def shorten(string, length = 30):
     if type(string) != str:
@@ -267,76 +1174,146 @@ def calc_top_counts(fp, system_gtfs):
 
    return top_counts, counts
 
-def top_counts_text(fp, gtfs_dir, width = 30):
-   top_counts, = calc_top_counts(fp, gtfs_dir)
-   print_top_counts(top_counts, stops, width)
+def top_counts_text(fp, gtfs_dir, width = 30, file = None):
+   '''
+   Print the top counts of the compass log pointed to by fp, naming bus stops
+   with the GTFS feed in gtfs_dir (which may also be an already loaded GTFS
+   tuple, or None to print stop numbers)
+   '''
+   system_gtfs = gtfs.read_gtfs_data(gtfs_dir) if isinstance(gtfs_dir, str) else gtfs_dir
+   top_counts, _ = calc_top_counts(fp, system_gtfs)
+   stops = system_gtfs.stop_id_to_code if system_gtfs else {}
+   print_top_counts(top_counts, stops, width, file)
+
+def top_counts_img(fp, db: retraceit_db, width = 1000, num = 14, system = system_t.TRANSLINK):
+   return stop_stats_img(analyze_history(fp), db, width = width, num = num, system = system)
 
-def top_counts_img(fp, db: retraceit_db, width = 1000, num = 14):
-   stops = db.gtfs[system_t.TRANSLINK].stop_id_to_code
-   lines = gtfs.get_stop_lines_dict(db.gtfs[system_t.TRANSLINK])
+def stop_stats_img(stats: HistoryStats, db: retraceit_db, width = 1000, num = 14, system = system_t.TRANSLINK):
+   # the feed may be reloaded while rendering, so hold on to the current copy
+   # until done
+   with db.use_gtfs(system) as system_gtfs:
+       stops = system_gtfs.stop_id_to_code
+       top_counts = get_top_counts(stats.stop_counts, num)
+       # precomputed when the feed was loaded
+       with metrics.span('stop_lines'):
+           lines = gtfs.get_stop_lines_dict(system_gtfs)
+           if system_gtfs.calendar:
+               # only the routes running on the days the stops were used
+               lines = {stop: gtfs.get_stop_lines_on(system_gtfs, stop, stats.bus_taps[stop])
+                        for stop, _ in top_counts[:num] if stop in stats.bus_taps}
 
-   return gen_img(*calc_top_counts(fp, db.gtfs[system_t.TRANSLINK]), lines, stops, 
-                  db, width = width, num = num)
+       return gen_img(top_counts, stats.stop_counts, lines, stops,
+                      db, width = width, num = num)
 
+@metrics.span('gen_img')
 def gen_img(top_counts, counts, lines, stops, db, width = 1000, num = 14,
             is_desc = True, title = 'Top Transit Stops', tap_title = 'Taps',
             category_title = 'Stops used', stat_format = '3d') -> Image:
    '''
    '''
-   height = 160+60*num if num < len(top_counts) else 160+60*len(top_counts)
-   img = Image.new('RGBA', (width, height), color=(0, 52, 86))
+   height = 160+60*num if num < len(counts) else 160+60*len(counts)
+   img = Image.new('RGBA', (width, height), color=BG_COLOUR)
    d = ImageDraw.Draw(img)
 
    header_text_xpos = 20
    if db.logo:
-       img.alpha_composite(db.logo, dest=(0, 0))
+       img.paste(db.sprites.header(width), (0, 0))
        header_text_xpos += 160
 
    d.text( (header_text_xpos, 10), title, font=db.title_fnt, fill='white')
 
    total_taps = sum([counts[stop] for stop in counts])
-   category_text = '; %s: %s' % (category_title, len(top_counts)) if category_title else ''
+   category_text = '; %s: %s' % (category_title, len(counts)) if category_title else ''
    d.text( (header_text_xpos, 90), ("%s: %" + stat_format + "%s") % (tap_title, total_taps, category_text),
                       font=db.fnt, fill='white')
 
    idx = 1
-   top_cnt = top_counts[0][1] if is_desc else max([cnt for stop, cnt in top_counts])
+   if not top_counts:
+       top_cnt = 0
+   else:
+       top_cnt = top_counts[0][1] if is_desc else max([cnt for stop, cnt in top_counts])
 
    for stop, cnt in top_counts[:num]:
        stop_name = stops[stop] if stop in stops else stop
        ypos = 100+60*idx
-       d.rectangle( (0, ypos, cnt/top_cnt*width, ypos+60 ), fill=(30, 82, 116))
+       # every count is 0 in the hourly chart of a history without taps, or
+       # the spend chart of one without fares
+       d.rectangle( (0, ypos, cnt/top_cnt*width if top_cnt else 0, ypos+60 ), fill=BAR_COLOUR)
        d.text( (width-100, ypos), ("%" + stat_format) % (cnt), font=db.fnt, fill='white')
 
        if stop_name in STN_BULLETS:
            text_xpos = 20 + len(STN_BULLETS[stop_name])*60
+           img.alpha_composite(db.sprites.bullet_row(stop_name), dest=(10, ypos))
 
-           for bullet_idx, bullet in enumerate(STN_BULLETS[stop_name]):
-               img.alpha_composite(db.bullets[bullet], dest=(10+60*bullet_idx, ypos))
-
-       elif stop in lines:
+       elif lines.get(stop):
            text_xpos = 20 + len(lines[stop])*76
            for rt_idx, rt_num in enumerate(lines[stop]):
                rt_box_xpos = 10+76*rt_idx
-               rect_colour = LINE_COLOURS[rt_num] if rt_num in LINE_COLOURS else (99, 130, 161)
+               badge = db.sprites.badge(rt_num)
 
-               d.rectangle( (rt_box_xpos, ypos, rt_box_xpos+72, ypos+54 ), fill=rect_colour)
-               d.multiline_text((rt_box_xpos+37, ypos+25), str(rt_num), font=db.fnt,
-                                fill='white', align='center', anchor='mm')
+               if badge:
+                   img.paste(badge, (rt_box_xpos, ypos))
+               else:
+                   draw_badge(d, rt_box_xpos, ypos, rt_num, db.fnt)
        else:
            text_xpos = 10
 
-       stop_text_len = d.textlength(stop_name, font=db.fnt)
-       while (text_xpos + stop_text_len > width-110 and len(stop_name) > 3):
-           stop_name = stop_name[:-4] + '...'
-           stop_text_len = d.textlength(stop_name, font=db.fnt)
-           
+       stop_name = db.fitter(db.fnt).fit(stop_name, width-110-text_xpos)
        if stop_name != '...':
            d.text( (text_xpos, ypos), stop_name, font=db.fnt, fill='white')
        idx += 1
 
    return img
 
+def route_counts(stats: HistoryStats, system_gtfs, window = ROUTE_WINDOW_MINS) -> dict:
+   '''
+   Return a dict mapping route numbers to the number of bus taps that were
+   rides on them
+       - bus taps only record the stop, so each is matched to the scheduled
+         departure from that stop closest to the time of the tap, if there is
+         one within window minutes (see gtfs.Departures). Taps with no
+         departure close enough are not counted.
+       - if the feed has a service calendar, only trips running on the day of
+         the tap can match (see gtfs.ServiceCalendar)
+   '''
+   departures = gtfs.get_departures(system_gtfs)
+   calendar = system_gtfs.calendar
+   counts, route_nums = {}, {}
+
+   for stop, times in stats.bus_taps.items():
+       for tap_time in times:
+           row = departures.nearest(stop, tap_time.hour*3600 + tap_time.minute*60, window*60, tap_time, calendar)
+           rt_id = departures.route_id(row) if row >= 0 else None
+           if rt_id is None:
+               continue
+           if rt_id not in route_nums:
+               route = system_gtfs.routes.get(rt_id)
+               route_nums[rt_id] = (route.num or route.name) if route else rt_id
+           rt_num = route_nums[rt_id]
+           counts[rt_num] = counts.get(rt_num, 0) + 1
+
+   return counts
+
+def top_routes_img(fp, db: retraceit_db, width = 1000, num = 14, window = ROUTE_WINDOW_MINS,
+                   system = system_t.TRANSLINK):
+   return route_stats_img(analyze_history(fp), db, width = width, num = num, window = window, system = system)
+
+def route_stats_img(stats: HistoryStats, db: retraceit_db, width = 1000, num = 14, window = ROUTE_WINDOW_MINS,
+                    system = system_t.TRANSLINK):
+   with db.use_gtfs(system) as system_gtfs:
+       with metrics.span('route_counts'):
+           counts = route_counts(stats, system_gtfs, window)
+
+       names = {}
+       for route in system_gtfs.routes.values():
+           rt_num = route.num or route.name
+           if rt_num in counts and rt_num not in names:
+               names[rt_num] = route.name or rt_num
+
+   return gen_img(get_top_counts(counts, num), counts, {rt_num: [rt_num] for rt_num in counts}, names,
+                  db, width = width, num = num, title = 'Top Bus Routes', tap_title = 'Rides',
+                  category_title = 'Routes ridden')
+
 def top_month_counts(fp, spend=False):
    trips = load_csv(fp)
    counts = get_month_counts(trips, spend=spend)
@@ -348,6 +1325,9 @@ def top_month_counts_text(fp, width = 10):
    print_top_counts(top_counts, width = width)
 
 def top_month_counts_img(fp, db, width = 800, spend=False):
+   return month_stats_img(analyze_history(fp), db, width = width, spend = spend)
+
+def month_stats_img(stats: HistoryStats, db, width = 800, spend=False):
    if spend:
        title = 'Spend by Month ($)'
        tap_title = 'Total Spend'
@@ -357,7 +1337,8 @@ def top_month_counts_img(fp, db, width = 800, spend=False):
        tap_title = 'Taps'
        stat_format = '3d'
 
-   top_counts, counts = top_month_counts(fp, spend=spend)
+   counts = stats.month_spend if spend else stats.month_counts
+   top_counts = get_top_counts(counts)
    return gen_img(top_counts, counts, {}, {}, db, width = width, num=len(counts), 
                   is_desc=False, title = title, tap_title = tap_title,
                   category_title='Months', stat_format = stat_format)
@@ -369,8 +1350,43 @@ def top_hr_counts(fp, width = 30):
    print_top_counts(top_counts, width = width)
 
 def top_hr_counts_img(fp, db, width = 800):
-   trips = load_csv(fp)
-   counts = get_hr_counts(trips)
+   return hr_stats_img(analyze_history(fp), db, width = width)
+
+def hr_stats_img(stats: HistoryStats, db, width = 800):
+   counts = stats.hr_counts
    top_counts = [(str(hr), cnt) for hr, cnt in sorted(list(counts.items()))]
    return gen_img(top_counts, counts, {}, {}, db, width = width, num=24, is_desc=False,
                   title='Taps by Hour', category_title=None)
+
+def all_stats_imgs(fp, db, width = 1050, num = 14, combine = False, system = system_t.TRANSLINK) -> list:
+   '''
+   Parse the compass log pointed to by fp once, and return the stop, hourly,
+   monthly tap and monthly spend images for it (see stats_imgs)
+   '''
+   return stats_imgs(analyze_history(fp), db, width = width, num = num, combine = combine, system = system)
+
+def stats_imgs(stats: HistoryStats, db, width = 1050, num = 14, combine = False, system = system_t.TRANSLINK) -> list:
+   '''
+   Return the stop, hourly, monthly tap and monthly spend images for the
+   statistics computed by analyze_history
+       - if combine is set, the images are stacked into a single image
+   '''
+   imgs = [stop_stats_img(stats, db, width = width, num = num, system = system),
+           hr_stats_img(stats, db, width = width),
+           month_stats_img(stats, db, width = width),
+           month_stats_img(stats, db, width = width, spend = True)]
+
+   return [stack_imgs(imgs)] if combine else imgs
+
+def stack_imgs(imgs) -> Image:
+   '''
+   Stack the given images vertically into a single image
+   '''
+   combined = Image.new('RGBA', (max([img.width for img in imgs]), sum([img.height for img in imgs])),
+                        color=(0, 52, 86))
+   ypos = 0
+   for img in imgs:
+       combined.paste(img, (0, ypos))
+       ypos += img.height
+
+   return combined
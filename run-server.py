@@ -1,63 +1,366 @@
-import discord, urllib, os, io
+import discord, urllib, os, io, time, asyncio
 from enum import Enum
 from datetime import datetime
-from PIL import Image
+from functools import partial
 import retraceit as rt
+import gtfs
+import render_queue, metrics, img_encode
+from content_cache import content_hash, lru_store
+from tap_store import tap_store
+
+# parsed histories, keyed by the hash of the uploaded csv, and encoded images,
+# keyed by (csv hash, render function, format, GTFS feed, parameters)
+HISTORY_CACHE_ENTRIES = int(os.environ.get('RETRACEIT_HISTORY_CACHE_ENTRIES', 256))
+IMG_CACHE_MB          = int(os.environ.get('RETRACEIT_IMG_CACHE_MB', 64))
+# load GTFS feeds, fonts and bullets in the background on startup, rather
+# than when the first request needs them
+WARM_UP = os.environ.get('RETRACEIT_WARM_UP', '1') != '0'
+# largest csv export accepted, in megabytes and in rows, and how many
+# requests each user may have in progress at once
+MAX_CSV_MB       = float(os.environ.get('RETRACEIT_MAX_CSV_MB', 10))
+MAX_CSV_ROWS     = int(os.environ.get('RETRACEIT_MAX_CSV_ROWS', 100000))
+USER_CONCURRENCY = int(os.environ.get('RETRACEIT_USER_CONCURRENCY', 2))
+# widest image that may be requested, in pixels
+MAX_IMG_WIDTH    = int(os.environ.get('RETRACEIT_MAX_IMG_WIDTH', 4000))
+# sqlite file to store each user's taps in (off by default). When set, stats
+# cover every tap a user has uploaded, and re-uploads only add their new rows.
+TAP_STORE = os.environ.get('RETRACEIT_TAP_STORE')
+# discord user ids allowed to use admin commands
+ADMIN_IDS = set([int(user_id) for user_id in os.environ.get('RETRACEIT_ADMIN_IDS', '').split(',') if user_id.strip()])
 
 rt_db = rt.retraceit_db()
+if WARM_UP:
+   rt_db.warm_up()
 bot = discord.Bot()
+renderer = render_queue.render_executor()
+history_cache = lru_store(HISTORY_CACHE_ENTRIES)
+tap_db = tap_store(TAP_STORE) if TAP_STORE else None
+# requests in progress, by discord user id
+user_requests = {}
+img_cache = lru_store(IMG_CACHE_MB << 20,
+                      sizeof=lambda imgs: sum([len(img) for img in imgs]) if isinstance(imgs, list) else len(imgs))
+
+class HistoryTooLarge(Exception):
+   '''
+   Raised by render_encoded for exports with more than MAX_CSV_ROWS rows
+   '''
+
+def count_rows(text: str) -> int:
+   # every row takes at least one line, so the exact count is only needed for
+   # files with more lines than the limit
+   lines = text.count('\n') + 1
+   return lines if lines <= MAX_CSV_ROWS else len(gtfs.grab_csv_lines(text))
+
+def render_params(render_func, fmt, kwargs) -> tuple:
+   '''
+   Return the part of an image's cache key that does not depend on the
+   upload: the render function, format, parameters and, for images drawn
+   from a GTFS feed, the fingerprint of the feed, so that images drawn from
+   a feed are not served once it has been reloaded
+   '''
+   feed = rt_db.feeds.get(kwargs['system']) if 'system' in kwargs else None
+   return (render_func.__name__, fmt, feed.fingerprint if feed else None, tuple(sorted(kwargs.items())))
+
+def render_encoded(render_func, contents: bytes, csv_hash: str, img_key, params, user_id, fmt, **kwargs):
+   '''
+   Render job run on the render executor: decode and parse the uploaded csv
+   (unless it is in the history cache), generate the image with render_func
+   and encode it as fmt (see img_encode.FORMATS)
+       - with a tap store, only the rows of the csv that are not stored for
+         user_id yet are parsed, and the image is made from all of the
+         user's stored taps
+       - if render_func returns a list of images, a list of encoded images is
+         returned
+   '''
+   with metrics.span(render_func.__name__, profile=True):
+      if tap_db is not None:
+         stats = None
+      else:
+         stats = history_cache.get(csv_hash)
+
+      if stats is None:
+         with metrics.span('decode'):
+            text = contents.decode('utf-8')
+         rows = count_rows(text)
+         if rows > MAX_CSV_ROWS:
+            raise HistoryTooLarge(rows)
+
+         if tap_db is not None:
+            with metrics.span('ingest'):
+               tap_db.ingest(user_id, text)
+            # the user's stats only change when taps are added or forgotten
+            img_key = (user_id, tap_db.generation(user_id)) + params
+            img_data = img_cache.get(img_key)
+            if img_data is not None:
+               return img_data
+            stats = tap_db.stats(user_id)
+         else:
+            stats = rt.analyze_history(text)
+            history_cache.put(csv_hash, stats)
+
+      imgs = render_func(stats, rt_db, **kwargs)
+
+      if isinstance(imgs, list):
+         img_data = [img_encode.encode(img, fmt) for img in imgs]
+      else:
+         img_data = img_encode.encode(imgs, fmt)
 
-async def upload_img(ctx, img: Image, fname: str, msg_text = 'Your generated image:'):
-   fp = io.BytesIO()
-   img.save(fp, format='png')
+   img_cache.put(img_key, img_data)
+   return img_data
 
-   # seek to beginning of saved image data
-   fp.seek(0)
+async def render(ctx, render_func, contents: bytes, fmt=img_encode.IMG_FORMAT, **kwargs):
+   '''
+   Render an image off the event loop, returning it encoded as fmt, or None
+   (after letting the user know) if it could not be rendered in time
+       - re-uploads of a csv with the same parameters are answered from the
+         image cache without parsing or rendering, and requests for an image
+         that is already being rendered share its result. With a tap store,
+         images also depend on the user's earlier uploads, so the image cache
+         is only checked once the upload has been stored (see render_encoded).
+       - each user may only have USER_CONCURRENCY requests in progress at once
+       - images may be at most MAX_IMG_WIDTH pixels wide
+   '''
+   start = time.perf_counter()
+   command = ctx.command.name if ctx.command else render_func.__name__
+
+   if not 0 < kwargs.get('width', 1) <= MAX_IMG_WIDTH:
+      metrics.record_command(command, time.perf_counter() - start, 'bad_width')
+      await ctx.followup.send("Sorry, images must be between 1 and %d pixels wide." % (MAX_IMG_WIDTH))
+      return None
+
+   user_id = ctx.author.id
+   csv_hash = content_hash(contents)
+   params = render_params(render_func, fmt, kwargs)
+   if tap_db is not None:
+      img_key = (user_id, csv_hash) + params
+   else:
+      img_key = (csv_hash,) + params
+      img_data = img_cache.get(img_key)
+      if img_data is not None:
+         metrics.record_command(command, time.perf_counter() - start, 'cached')
+         return img_data
+
+   if user_requests.get(user_id, 0) >= USER_CONCURRENCY:
+      metrics.record_command(command, time.perf_counter() - start, 'user_limit')
+      await ctx.followup.send("You already have %d images being generated, please wait for them to finish." %
+                              (user_requests[user_id]))
+      return None
+
+   async def on_queued(position):
+      await ctx.followup.send("All renderers are busy, your image is #%d in the queue..." % (position))
+
+   status = 'coalesced' if img_key in renderer.shared else 'ok'
+   user_requests[user_id] = user_requests.get(user_id, 0) + 1
+   try:
+      return await renderer.run_shared(img_key, partial(render_encoded, render_func, contents, csv_hash, img_key, params, user_id, fmt, **kwargs),
+                                       on_queued=on_queued)
+   except HistoryTooLarge as e:
+      status = 'too_large'
+      await ctx.followup.send("Sorry, your file has too many rows (%d, the limit is %d)." % (e.args[0], MAX_CSV_ROWS))
+   except render_queue.RenderQueueFull:
+      status = 'busy'
+      await ctx.followup.send("Retraceit is too busy right now, please try again in a few minutes.")
+   except asyncio.TimeoutError:
+      status = 'timeout'
+      await ctx.followup.send("Sorry, your image took too long to generate. Please try again later.")
+   except Exception:
+      status = 'error'
+      raise
+   finally:
+      user_requests[user_id] -= 1
+      if not user_requests[user_id]:
+         del user_requests[user_id]
+      metrics.record_command(command, time.perf_counter() - start, status)
+   return None
+
+async def read_history(ctx, attachment) -> bytes:
+   '''
+   Download an uploaded csv export, or return None (after letting the user
+   know) if it is larger than MAX_CSV_MB
+   '''
+   if attachment.size > MAX_CSV_MB * (1 << 20):
+      await ctx.followup.send("Sorry, your file is too large (%.1fMB, the limit is %gMB)." %
+                              (attachment.size / (1 << 20), MAX_CSV_MB))
+      return None
+   return await attachment.read()
+
+async def upload_img(ctx, img_data: bytes, fname: str, msg_text = 'Your generated image:'):
+   if img_data is None:
+      return
+
+   fp = io.BytesIO(img_data)
    await ctx.followup.send(msg_text, file=discord.File(fp, filename=fname))
    fp.close()
 
+async def upload_imgs(ctx, imgs_data: list, fnames: list, msg_text = 'Your generated images:'):
+   if imgs_data is None:
+      return
+
+   files = [discord.File(io.BytesIO(img_data), filename=fname)
+            for img_data, fname in zip(imgs_data, fnames)]
+   await ctx.followup.send(msg_text, files=files)
+
 @bot.slash_command()
 async def test(ctx):
     await ctx.respond("as of %s, we are online!" % (datetime.now()))
 
+async def check_admin(ctx) -> bool:
+   if ctx.author.id in ADMIN_IDS:
+      return True
+   await ctx.respond("Sorry, this command is only available to Retraceit admins.", ephemeral=True)
+   return False
+
+@bot.slash_command()
+async def retraceit_stats(ctx):
+   '''
+   Admin only: recent latency percentiles of each command and stage
+   '''
+   if not await check_admin(ctx):
+      return
+
+   lines = ["%-24s %7s %9s %9s" % ('', 'count', 'p50 (ms)', 'p99 (ms)')]
+   for metric, title in (('retraceit_command_seconds', 'commands'), ('retraceit_stage_seconds', 'stages')):
+      lines.append(title + ':')
+      for labels, (count, (p50, p99)) in sorted(metrics.REGISTRY.percentiles(metric).items()):
+         lines.append("%-24s %7d %9.1f %9.1f" % (dict(labels).get('command', dict(labels).get('stage')),
+                                                 count, p50*1000, p99*1000))
+   lines.append('encoded image sizes:')
+   for labels, (count, (p50, p99)) in sorted(metrics.REGISTRY.percentiles('retraceit_encoded_bytes').items()):
+      lines.append("%-24s %7d %7.0fKB %7.0fKB" % (dict(labels)['format'], count, p50 / 1024, p99 / 1024))
+   feeds = rt_db.feeds
+   lines.append("gtfs feeds: %s; %.0fMB loaded%s, %d shared strings (%.1fMB)" %
+                (', '.join(["%s %s" % (feed.name, '%.1fMB' % (feed.footprint / (1 << 20)) if feed.loaded() else 'unloaded')
+                            for feed in feeds.values()]),
+                 feeds.footprint() / (1 << 20),
+                 ' of %.0fMB' % (feeds.memory_budget / (1 << 20)) if feeds.memory_budget else '',
+                 len(gtfs.STRINGS), gtfs.STRINGS.size() / (1 << 20)))
+   lines.append("render queue: %d running/queued; history cache: %d%% hits; image cache: %d%% hits" %
+                (renderer.pending,
+                 100 * history_cache.hits / max(1, history_cache.hits + history_cache.misses),
+                 100 * img_cache.hits / max(1, img_cache.hits + img_cache.misses)))
+   await ctx.respond("```\n%s\n```" % ('\n'.join(lines)), ephemeral=True)
+
+@bot.slash_command()
+async def retraceit_reload(ctx, system: rt.system_t,
+                           force: discord.Option(bool, description="reload even if the GTFS files have not changed", name="force") = False):
+   '''
+   Admin only: reload a system's GTFS feed (e.g. after downloading a new one)
+   without restarting the bot
+   '''
+   if not await check_admin(ctx):
+      return
+   await ctx.response.defer(ephemeral=True)
+
+   system = rt.system_t(system)
+   if system not in rt_db.feeds:
+      await ctx.followup.send("No GTFS feed is configured for %s." % (system.name.lower()), ephemeral=True)
+      return
+   # renders keep using the current feed while the new one is built
+   report = await asyncio.to_thread(rt_db.reload_gtfs, system, bool(force))
+   if report is None:
+      await ctx.followup.send("A reload is already in progress.", ephemeral=True)
+   elif not report['changed']:
+      await ctx.followup.send("The GTFS files have not changed since they were loaded.", ephemeral=True)
+   else:
+      await ctx.followup.send("Reloaded GTFS data in %.1fs, peak memory use %.0fMB%s." %
+                              (report['duration_s'], report['peak_rss_mb'],
+                               " (%d renders are still using the old data)" % (report['pending_users'])
+                               if report['pending_users'] else ''), ephemeral=True)
+
+@bot.slash_command()
+async def retraceit_forget(ctx):
+   '''
+   Delete the taps stored from your uploaded histories
+   '''
+   if tap_db is None:
+      await ctx.respond("Retraceit does not store your uploaded histories.", ephemeral=True)
+      return
+   await asyncio.to_thread(tap_db.forget, ctx.author.id)
+   # images of the deleted taps, keyed by (user id, generation, ...)
+   img_cache.discard_if(lambda key: key[0] == ctx.author.id)
+   await ctx.respond("Your stored taps have been deleted.", ephemeral=True)
+
+@bot.command()
+async def gen_stop_stats(ctx, num: discord.Option(input_type=int, description="the number of stops to list", name="num"), system: rt.system_t, compass_history_csv: discord.Attachment, img_width: discord.Option(input_type=int, descrption="width of the generated image, in pixels", name="img_width") = 1050,
+                         img_format: discord.Option(str, description="format of the generated image", name="img_format", choices=list(img_encode.FORMATS)) = img_encode.IMG_FORMAT):
+   await ctx.response.defer()
+   contents = await read_history(ctx, compass_history_csv)
+   if contents is None:
+      return
+
+   img = await render(ctx, rt.stop_stats_img, contents, img_format, width=int(img_width), num=int(num),
+                      system=rt.system_t(system))
+   await upload_img(ctx, img, img_encode.filename('stop_stats', img_format))
+
 @bot.command()
-async def gen_stop_stats(ctx, num: discord.Option(input_type=int, description="the number of stops to list", name="num"), system: rt.system_t, compass_history_csv: discord.Attachment, img_width: discord.Option(input_type=int, descrption="width of the generated image, in pixels", name="img_width") = 1050):
+async def gen_route_stats(ctx, num: discord.Option(input_type=int, description="the number of routes to list", name="num"), system: rt.system_t, compass_history_csv: discord.Attachment,
+                          img_width: discord.Option(input_type=int, description="width of the generated image, in pixels", name="img_width") = 1050,
+                          window: discord.Option(input_type=int, description="how many minutes a bus may depart before or after a tap to be counted", name="window") = rt.ROUTE_WINDOW_MINS,
+                          img_format: discord.Option(str, description="format of the generated image", name="img_format", choices=list(img_encode.FORMATS)) = img_encode.IMG_FORMAT):
    await ctx.response.defer()
-   contents = await compass_history_csv.read()
-   contents = contents.decode('utf-8')
+   contents = await read_history(ctx, compass_history_csv)
+   if contents is None:
+      return
 
-   img = rt.top_counts_img(contents, rt_db, width=int(img_width), num=int(num))
-   await upload_img(ctx, img, 'stop_stats.png')
+   img = await render(ctx, rt.route_stats_img, contents, img_format, width=int(img_width), num=int(num), window=int(window),
+                      system=rt.system_t(system))
+   await upload_img(ctx, img, img_encode.filename('route_stats', img_format),
+                    "Routes are inferred from the time of each bus tap and the schedule, so some rides may be missing or misattributed.")
 
 @bot.command()
 async def gen_time_stats(ctx, system: rt.system_t, compass_history_csv: discord.Attachment,
-                         img_width: discord.Option(input_type=int, descrption="width of the generated image, in pixels", name="img_width") = 800):
+                         img_width: discord.Option(input_type=int, descrption="width of the generated image, in pixels", name="img_width") = 800,
+                         img_format: discord.Option(str, description="format of the generated image", name="img_format", choices=list(img_encode.FORMATS)) = img_encode.IMG_FORMAT):
    await ctx.response.defer()
-   contents = await compass_history_csv.read()
-   contents = contents.decode('utf-8')
+   contents = await read_history(ctx, compass_history_csv)
+   if contents is None:
+      return
 
-   img = rt.top_hr_counts_img(contents, rt_db, width=int(img_width))
-   await upload_img(ctx, img, 'stop_stats.png')
+   img = await render(ctx, rt.hr_stats_img, contents, img_format, width=int(img_width))
+   await upload_img(ctx, img, img_encode.filename('stop_stats', img_format))
 
 @bot.command()
 async def gen_month_stats(ctx, system: rt.system_t, compass_history_csv: discord.Attachment,
-                          img_width: discord.Option(input_type=int, description="width of the generated image, in pixels", name="img_width") = 800):
+                          img_width: discord.Option(input_type=int, description="width of the generated image, in pixels", name="img_width") = 800,
+                          img_format: discord.Option(str, description="format of the generated image", name="img_format", choices=list(img_encode.FORMATS)) = img_encode.IMG_FORMAT):
    await ctx.response.defer()
-   contents = await compass_history_csv.read()
-   contents = contents.decode('utf-8')
+   contents = await read_history(ctx, compass_history_csv)
+   if contents is None:
+      return
 
-   img = rt.top_month_counts_img(contents, rt_db, width=int(img_width))
-   await upload_img(ctx, img, 'stop_stats.png')
+   img = await render(ctx, rt.month_stats_img, contents, img_format, width=int(img_width))
+   await upload_img(ctx, img, img_encode.filename('stop_stats', img_format))
 
 @bot.command()
 async def gen_monthly_cost_stats(ctx, system: rt.system_t, compass_history_csv: discord.Attachment,
-                                 img_width: discord.Option(input_type=int, description="width of the generated image, in pixels", name="img_width") = 800):
+                                 img_width: discord.Option(input_type=int, description="width of the generated image, in pixels", name="img_width") = 800,
+                                 img_format: discord.Option(str, description="format of the generated image", name="img_format", choices=list(img_encode.FORMATS)) = img_encode.IMG_FORMAT):
    await ctx.response.defer()
-   contents = await compass_history_csv.read()
-   contents = contents.decode('utf-8')
+   contents = await read_history(ctx, compass_history_csv)
+   if contents is None:
+      return
 
-   img = rt.top_month_counts_img(contents, rt_db, width=int(img_width), spend=True)
-   await upload_img(ctx, img, 'stop_stats.png',
+   img = await render(ctx, rt.month_stats_img, contents, img_format, width=int(img_width), spend=True)
+   await upload_img(ctx, img, img_encode.filename('stop_stats', img_format),
                     "Note that costs of any passes purchased are not included in these totals.")
 
+@bot.command()
+async def gen_all_stats(ctx, num: discord.Option(input_type=int, description="the number of stops to list", name="num"), system: rt.system_t, compass_history_csv: discord.Attachment,
+                        img_width: discord.Option(input_type=int, description="width of the generated images, in pixels", name="img_width") = 1050,
+                        combine: discord.Option(bool, description="combine all charts into a single image", name="combine") = False,
+                        img_format: discord.Option(str, description="format of the generated image", name="img_format", choices=list(img_encode.FORMATS)) = img_encode.IMG_FORMAT):
+   await ctx.response.defer()
+   contents = await read_history(ctx, compass_history_csv)
+   if contents is None:
+      return
+
+   # all charts come from a single parse of the history
+   imgs = await render(ctx, rt.stats_imgs, contents, img_format, width=int(img_width), num=int(num),
+                       combine=bool(combine), system=rt.system_t(system))
+   fnames = [img_encode.filename(name, img_format)
+             for name in (['all_stats'] if combine else ['stop_stats', 'time_stats', 'month_stats', 'monthly_cost_stats'])]
+   await upload_imgs(ctx, imgs, fnames,
+                     "Note that costs of any passes purchased are not included in the spend totals.")
+
+metrics.start_exporters()
 bot.run(os.environ.get("RETRACEIT_TOKEN"))
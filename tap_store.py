@@ -0,0 +1,229 @@
+import sqlite3, threading
+import retraceit as rt
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS taps (
+    user_id TEXT, time TEXT, trans TEXT, ordr_num TEXT, auth_code TEXT, occurrence INTEGER,
+    stn TEXT, product TEXT, am REAL, bal REAL, journey_id TEXT, location_disp TEXT,
+    PRIMARY KEY (user_id, time, trans, ordr_num, auth_code, occurrence)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stop_counts (
+    user_id TEXT, stn TEXT, newest INTEGER, taps INTEGER,
+    PRIMARY KEY (user_id, stn)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hr_counts (
+    user_id TEXT, hr INTEGER, taps INTEGER,
+    PRIMARY KEY (user_id, hr)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS month_stats (
+    user_id TEXT, month TEXT, newest INTEGER, taps INTEGER, spend REAL,
+    PRIMARY KEY (user_id, month)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS totals (
+    user_id TEXT PRIMARY KEY, taps INTEGER, spend REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS generations (
+    user_id TEXT PRIMARY KEY, generation INTEGER
+) WITHOUT ROWID;
+'''
+
+class tap_store:
+    '''
+    SQLite store of the taps in each user's uploaded Compass exports, and of
+    their statistics, which are updated as taps are added. Exports are
+    cumulative, so re-uploading one only parses and counts the rows added
+    since the last upload.
+        - rows are identified by their time (as written in the export),
+          transaction, order number and auth code. Times only have minute
+          precision and tap rows have no order number, so a row appearing n
+          times in an export is stored n times: the nth copy is only new if
+          fewer than n copies are stored.
+        - stats() covers every tap stored for the user, so an export that
+          only covers part of their history still adds to the rest. As rows
+          older than the newest stored minute of an export are not read, taps
+          from before the stored ones are only added by an export that
+          doesn't reach the stored ones.
+        - generation(user_id) changes whenever the user's taps do (including
+          when they are forgotten), and never goes back to an earlier value
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def ingest(self, user_id, fp) -> int:
+        '''
+        Add the taps of the compass log pointed to by fp (see load_csv) that
+        are not stored for user_id yet, returning how many were added
+            - exports list the newest taps first, and each covers everything
+              before it, so the export is only read from the top down to the
+              newest minute that has taps stored (see _new_rows): the rest of
+              it is not parsed, and the time taken depends on the number of
+              new taps rather than on the size of the export
+        '''
+        user_id = str(user_id)
+        with self._lock:
+            new_rows = _new_rows(self._db, user_id)
+            taps = rt.load_csv(fp, new_rows.is_new)
+            if not taps:
+                return 0
+
+            rows = [(user_id, *key, tap.stn, tap.product, tap.am, tap.bal, tap.journey_id, tap.location_disp)
+                    for key, tap in zip(new_rows.keys, taps)]
+            with self._db:
+                self._db.executemany('INSERT OR IGNORE INTO taps VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+                self._add_stats(user_id, rt.tally_taps(taps), _newest_taps(taps, new_rows.positions))
+                self._next_generation(user_id)
+            return len(taps)
+
+    def _next_generation(self, user_id):
+        self._db.execute('INSERT INTO generations VALUES (?, 1) ON CONFLICT (user_id) '
+                         'DO UPDATE SET generation = generation + 1', (user_id,))
+
+    def _add_stats(self, user_id, new_stats: rt.HistoryStats, newest: dict):
+        # newest (see _newest_taps) ranks stops and months by their newest tap
+        # rather than by when they were stored, so that stats() lists them in
+        # the same order however the taps were uploaded
+        self._db.executemany('INSERT INTO stop_counts VALUES (?,?,?,?) ON CONFLICT (user_id, stn) '
+                             'DO UPDATE SET taps = taps + excluded.taps, newest = MAX(newest, excluded.newest)',
+                             [(user_id, stn, newest[stn], taps) for stn, taps in new_stats.stop_counts.items()])
+        self._db.executemany('INSERT INTO month_stats VALUES (?,?,?,?,?) ON CONFLICT (user_id, month) '
+                             'DO UPDATE SET taps = taps + excluded.taps, spend = spend + excluded.spend, '
+                             'newest = MAX(newest, excluded.newest)',
+                             [(user_id, month, newest[month], taps, new_stats.month_spend[month])
+                              for month, taps in new_stats.month_counts.items()])
+
+        self._db.executemany('INSERT INTO hr_counts VALUES (?,?,?) ON CONFLICT (user_id, hr) '
+                             'DO UPDATE SET taps = taps + excluded.taps',
+                             [(user_id, hr, taps) for hr, taps in new_stats.hr_counts.items() if taps])
+        self._db.execute('INSERT INTO totals VALUES (?,?,?) ON CONFLICT (user_id) '
+                         'DO UPDATE SET taps = taps + excluded.taps, spend = spend + excluded.spend',
+                         (user_id, new_stats.total_taps, new_stats.total_spend))
+
+    def stats(self, user_id) -> rt.HistoryStats:
+        '''
+        Return the statistics of every tap stored for user_id, as
+        analyze_history would for an export containing all of them: stops,
+        months and bus stops are listed in the order they first appear in a
+        newest-first export, i.e. by their newest tap
+        '''
+        user_id = str(user_id)
+        with self._lock:
+            stop_counts = dict(self._db.execute('SELECT stn, taps FROM stop_counts WHERE user_id = ? '
+                                                'ORDER BY newest DESC', (user_id,)))
+            hr_counts = {hr: 0 for hr in range(0, 24)}
+            hr_counts.update(self._db.execute('SELECT hr, taps FROM hr_counts WHERE user_id = ?', (user_id,)))
+            months = self._db.execute('SELECT month, taps, spend FROM month_stats WHERE user_id = ? '
+                                      'ORDER BY newest DESC', (user_id,)).fetchall()
+            totals = self._db.execute('SELECT taps, spend FROM totals WHERE user_id = ?', (user_id,)).fetchone()
+            bus_taps = self._db.execute('SELECT taps.stn, time, COUNT(*) FROM taps JOIN stop_counts USING (user_id, stn) '
+                                        "WHERE user_id = ? AND taps.stn GLOB '[0-9]*' "
+                                        'GROUP BY taps.stn, time ORDER BY MAX(newest) DESC', (user_id,)).fetchall()
+
+        rt.cleanup_data(stop_counts)
+        total_taps, total_spend = totals or (0, 0)
+        return rt.HistoryStats(stop_counts, hr_counts, {month: taps for month, taps, _ in months},
+                               {month: spend for month, _, spend in months}, total_taps, total_spend,
+                               _bus_taps(bus_taps))
+
+    def generation(self, user_id) -> int:
+        '''
+        Return the version of the taps stored for user_id (0 if none were
+        ever stored)
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT generation FROM generations WHERE user_id = ?',
+                                   (str(user_id),)).fetchone()
+        return row[0] if row else 0
+
+    def count(self, user_id) -> int:
+        '''
+        Return the number of taps stored for user_id
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT taps FROM totals WHERE user_id = ?', (str(user_id),)).fetchone()
+        return row[0] if row else 0
+
+    def forget(self, user_id):
+        '''
+        Delete everything stored for user_id
+        '''
+        with self._lock, self._db:
+            for table in ('taps', 'stop_counts', 'hr_counts', 'month_stats', 'totals'):
+                self._db.execute('DELETE FROM %s WHERE user_id = ?' % (table), (str(user_id),))
+            self._next_generation(str(user_id))
+
+class _new_rows:
+    '''
+    Picks the rows of a newest-first export that are not stored for a user
+    (is_new is load_csv's callback)
+        - the stored copies of each key are looked up one minute at a time, as
+          the rows of a minute are next to each other. Rows with more copies
+          in the export than are stored are new.
+        - once a minute with stored taps has been read, reading stops: every
+          older row was stored along with it
+        - keys holds the (time, transaction, order number, auth code,
+          occurrence) of each new row, in the order of the export, and
+          positions the position of each among the rows of its minute
+    '''
+    def __init__(self, db, user_id):
+        self.db        = db
+        self.user_id   = user_id
+        # a first upload has nothing to look up
+        self.lookup    = db.execute('SELECT 1 FROM taps WHERE user_id = ? LIMIT 1', (user_id,)).fetchone() is not None
+        self.time      = None
+        self.stored    = {}
+        self.seen      = {}
+        self.keys      = []
+        self.positions = []
+        self.position  = 0
+
+    def is_new(self, time, trans, ordr_num, auth_code):
+        if time != self.time:
+            if self.stored:
+                return None
+            self.time, self.position = time, 0
+            if self.lookup:
+                self.stored = {(trans, ordr_num, auth_code): copies for trans, ordr_num, auth_code, copies in
+                               self.db.execute('SELECT trans, ordr_num, auth_code, COUNT(*) FROM taps '
+                                               'WHERE user_id = ? AND time = ? GROUP BY trans, ordr_num, auth_code',
+                                               (self.user_id, time))}
+
+        key = (time, trans, ordr_num, auth_code)
+        copies = self.seen.get(key, 0)
+        self.seen[key] = copies + 1
+        self.position += 1
+        if copies < self.stored.get(key[1:], 0):
+            return False
+        self.keys.append((*key, copies))
+        self.positions.append(self.position - 1)
+        return True
+
+def _newest_taps(taps, positions) -> dict:
+    # rank of the newest of the given taps at each stop and in each month (as
+    # tally_taps names them): its minute, then its position in the minute
+    # (see _new_rows), earlier rows ranking higher as they come first
+    newest = {}
+    for tap, position in zip(taps, positions):
+        tap_time = tap.time
+        rank = (tap_time.toordinal()*1440 + tap_time.hour*60 + tap_time.minute) * 1000 + 999 - min(position, 999)
+        for key in (tap.stn, "%s-%s" % (tap_time.year, tap_time.month)):
+            if rank > newest.get(key, -1):
+                newest[key] = rank
+    return newest
+
+def _bus_taps(rows) -> dict:
+    # HistoryStats.bus_taps from (stop number, export time, copies) rows, in
+    # the order of their stops; the times of each stop are listed newest
+    # first, as in an export
+    bus_taps, times = {}, {}
+    for stn, time, copies in rows:
+        if time not in times:
+            times[time] = rt.parse_tap_time(time)
+        if stn.isdigit() and times[time]:
+            bus_taps.setdefault(stn, []).extend([times[time]] * copies)
+    for stop_times in bus_taps.values():
+        stop_times.sort(reverse=True)
+    return bus_taps
@@ -0,0 +1,78 @@
+import os, sys, json, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEADER = ('DateTime,Transaction,Product,LineItem,Amount,BalanceDetails,JourneyId,LocationDisplay,'
+          'TransactonTime,OrderDate,Payment,OrderNumber,AuthCode,Total\n')
+# exports without a single tap: nothing at all, and only card loads
+HISTORIES = {
+    'empty': HEADER,
+    'loads_only': HEADER + 'Jan-02-2015 05:49 AM,Loaded at Metrotown Stn,Stored Value,,$20.00,$44.06,4,'
+                           '"Loaded at Metrotown Stn\nStored Value",,,,1004,A4,\n',
+}
+
+# the smallest feed the charts load
+GTFS_FILES = {
+    'routes.txt': 'route_id,route_short_name,route_long_name,route_type,route_color,route_text_color\n'
+                  'R1,1,Test Route,3,,\n',
+    'trips.txt': 'route_id,service_id,trip_id\nR1,S1,T1\n',
+    'stops.txt': 'stop_id,stop_code,stop_name\nS1,50001,Test Stop\n',
+    'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\nT1,08:00:00,08:00:00,S1,1\n',
+}
+
+def setUpModule():
+    global rt, batch, tmp_dir
+    if not os.environ.get('RETRACEIT_FNTFILE'):
+        raise unittest.SkipTest('RETRACEIT_FNTFILE is not set')
+
+    tmp_dir = tempfile.mkdtemp()
+    gtfs_dir = os.path.join(tmp_dir, 'gtfs')
+    os.mkdir(gtfs_dir)
+    for fname, text in GTFS_FILES.items():
+        with open(os.path.join(gtfs_dir, fname), 'w', encoding='utf-8') as fp:
+            fp.write(text)
+    os.environ['RETRACEIT_TRANSLINK_GTFSDIR'] = gtfs_dir
+    os.environ['RETRACEIT_GTFS_FEEDS'] = ''
+    os.environ['RETRACEIT_GTFS_CONFIG'] = ''
+
+    import retraceit as rt
+    import batch
+
+def tearDownModule():
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class EmptyHistoryTest(unittest.TestCase):
+    '''
+    Histories without taps still get every chart, with empty bars
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.db = rt.retraceit_db()
+
+    def test_charts(self):
+        for name, text in HISTORIES.items():
+            with self.subTest(history=name):
+                stats = rt.analyze_history(text)
+                self.assertEqual(stats.total_taps, 0)
+                self.assertEqual(len(rt.stats_imgs(stats, self.db)), 4)
+                self.assertEqual(len(rt.stats_imgs(stats, self.db, combine=True)), 1)
+                rt.route_stats_img(stats, self.db)
+
+class EmptyHistoryBatchTest(unittest.TestCase):
+    '''
+    A batch of histories without taps succeeds with the default reports
+    '''
+    def test_batch(self):
+        source, out_dir = os.path.join(tmp_dir, 'histories'), os.path.join(tmp_dir, 'out')
+        os.makedirs(source, exist_ok=True)
+        for name, text in HISTORIES.items():
+            with open(os.path.join(source, name + '.csv'), 'w', encoding='utf-8') as fp:
+                fp.write(text)
+
+        self.assertEqual(batch.main([source, out_dir, '--workers', '1']), 0)
+        with open(os.path.join(out_dir, batch.SUMMARY_FNAME), encoding='utf-8') as fp:
+            summary = json.load(fp)
+        self.assertEqual((summary['ok'], summary['failed']), (len(HISTORIES), 0))
+
+if __name__ == '__main__':
+    unittest.main()